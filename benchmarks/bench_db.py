@@ -0,0 +1,109 @@
+"""
+Throughput of the user settings lookup every synthesis handler does (create user on the first request, read settings)
+with 100k users in the database, handlers run concurrently on the event loop like updates do:
+blocking per-setting queries on the event loop (as before) vs async db facade with the settings cache,
+loop stall - the longest time the event loop couldn't run anything else (e.g. updates of other users)
+run from repo directory: python -m benchmarks.bench_db
+"""
+import os
+import time
+import random
+import asyncio
+import sqlite3
+import tempfile
+from typing import Awaitable, Callable, Dict, List
+import voice_bot.modules.bot_settings as bot_settings
+from voice_bot.modules.bot_db import USERS_TABLE, VOICES_TABLE, AsyncDBHandle, DBHandle
+
+
+USERS = 100_000
+VOICE_USERS = 10_000  # users with an active custom voice
+REQUESTS = 20_000
+CONCURRENCY = 32  # default number of concurrently handled updates
+
+
+def create_db(db_path: str) -> None:
+    handle = DBHandle(db_path)
+    with handle.conn:
+        handle.conn.executemany(f"INSERT INTO {USERS_TABLE} (uid,emotion_type,sample_num) VALUES (?,?,?)",
+                                [(uid, uid % 5, 1 + uid % 3) for uid in range(USERS)])
+        handle.conn.executemany(f"INSERT INTO {VOICES_TABLE} (id,user_fid,name,path) VALUES (?,?,?,?)",
+                                [(uid, uid, f"voice_{uid}", f"/voices/{uid}/voice_{uid}") for uid in range(VOICE_USERS)])
+        handle.conn.executemany(f"UPDATE {USERS_TABLE} SET voice_fid=? WHERE uid=?", [(uid, uid) for uid in range(VOICE_USERS)])
+
+
+class BlockingLookup(object):
+    """settings lookup as it was done before: f-string queries, one per setting, blocking the event loop"""
+    def __init__(self, db_path: str) -> None:
+        self.conn = sqlite3.connect(db_path)
+
+    async def handle(self, user_id: int) -> None:
+        with self.conn:
+            res = self.conn.execute(f"SELECT * FROM {USERS_TABLE} WHERE uid={user_id}")
+            if res.fetchone() is None:
+                self.conn.execute(f"INSERT INTO {USERS_TABLE} (uid) VALUES ({user_id})")
+        self.conn.execute(f"""SELECT {USERS_TABLE}.default_voice, {USERS_TABLE}.voice_fid,{VOICES_TABLE}.name
+            FROM {USERS_TABLE}
+            LEFT JOIN {VOICES_TABLE} ON {USERS_TABLE}.voice_fid={VOICES_TABLE}.id
+            WHERE {USERS_TABLE}.uid={user_id}""").fetchone()
+        self.conn.execute(f"SELECT emotion_type FROM {USERS_TABLE} WHERE uid={user_id}").fetchone()
+        self.conn.execute(f"SELECT sample_num FROM {USERS_TABLE} WHERE uid={user_id}").fetchone()
+
+
+class CachedLookup(object):
+    """settings lookup of the handlers: settings cache in front of the async db facade"""
+    def __init__(self, db_path: str) -> None:
+        bot_settings.db_async = AsyncDBHandle(DBHandle(db_path))
+        self.cache = bot_settings.UserSettingsCache()
+
+    async def handle(self, user_id: int) -> None:
+        await self.cache.init_user(user_id)
+        await self.cache.get(user_id)
+
+
+async def run_requests(handle: Callable[[int], Awaitable], user_ids: List[int]) -> Dict[str, float]:
+    latencies = []
+    stalls = [0.]
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    running = True
+
+    async def watch_loop() -> None:
+        while running:
+            started_at = time.monotonic()
+            await asyncio.sleep(0)
+            stalls.append(time.monotonic() - started_at)
+
+    async def request(user_id: int) -> None:
+        async with semaphore:
+            started_at = time.monotonic()
+            await handle(user_id)
+            latencies.append(time.monotonic() - started_at)
+
+    watcher = asyncio.create_task(watch_loop())
+    started_at = time.monotonic()
+    await asyncio.gather(*(request(user_id) for user_id in user_ids))
+    elapsed = time.monotonic() - started_at
+    running = False
+    await watcher
+    latencies.sort()
+    return {"rps": len(user_ids) / elapsed, "p95": latencies[int(.95 * len(latencies))], "stall": max(stalls)}
+
+
+def main() -> None:
+    rng = random.Random(0)
+    user_ids = [rng.randrange(USERS + USERS // 10) for _ in range(REQUESTS)]  # some of them are new users
+    print(f"{REQUESTS} requests of {USERS} users, {CONCURRENCY} handled concurrently")
+    print(f"{'mode':<30}{'requests/s':>12}{'p95':>10}{'loop stall':>12}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for mode, lookup_class, passes in (("blocking queries", BlockingLookup, ("",)),
+                                           ("async + settings cache", CachedLookup, (", cold", ", warm"))):
+            db_path = os.path.join(temp_dir, f"{lookup_class.__name__}.db")
+            create_db(db_path)
+            lookup = lookup_class(db_path)
+            for suffix in passes:
+                result = asyncio.run(run_requests(lookup.handle, user_ids))
+                print(f"{mode + suffix:<30}{result['rps']:>12.0f}{result['p95'] * 1000:>8.2f}ms{result['stall'] * 1000:>10.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Tail latency of short synthesis jobs under a mixed workload, with a stub tts backend on a single worker:
+long jobs of a few heavy users are queued at once, short one-clip jobs of light users arrive meanwhile,
+jobs run one by one (as before clip interleaving) vs clip by clip interleaved
+run from repo directory: python -m benchmarks.bench_scheduler
+"""
+import time
+from threading import Timer
+from typing import Dict, List
+from voice_bot.modules.bot_utils import config
+from voice_bot.modules.tts_queue import TTSJobQueue
+from voice_bot.modules.tts_scheduler import TTSWorkerPool
+from tests.stubs import StubBackend, make_job
+
+
+CLIP_TIME = 0.02  # seconds of stub synthesis per clip
+HEAVY_USERS = 3
+HEAVY_JOBS = 2  # per heavy user
+HEAVY_CLIPS = 15
+LIGHT_USERS = 30
+LIGHT_INTERVAL = 0.1  # seconds between light users requests
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def run_workload(max_batch_jobs: int) -> Dict[str, float]:
+    config.max_batch_jobs = max_batch_jobs
+    queue = TTSJobQueue()
+    pool = TTSWorkerPool(lambda device: StubBackend(device, CLIP_TIME), queue)
+    pool.start([0])
+    while not pool.is_ready():
+        time.sleep(0.01)
+
+    started_at = time.monotonic()
+    heavy_jobs = [make_job(user_id, clips=HEAVY_CLIPS) for user_id in range(HEAVY_USERS) for _ in range(HEAVY_JOBS)]
+    for job in heavy_jobs:
+        queue.put(job)
+    light_jobs = [make_job(HEAVY_USERS + ind) for ind in range(LIGHT_USERS)]
+    put_times = {}
+
+    def put_light(job) -> None:
+        put_times[job.job_id] = time.monotonic()
+        queue.put(job)
+
+    timers = [Timer(LIGHT_INTERVAL * (ind + 1), put_light, (job,)) for ind, job in enumerate(light_jobs)]
+    for timer in timers:
+        timer.start()
+
+    light_latencies = []
+    for job in light_jobs:
+        job.future.result()
+        light_latencies.append(time.monotonic() - put_times[job.job_id])
+    for job in heavy_jobs:
+        job.future.result()
+    pool.stop()
+    return {"p50": percentile(light_latencies, .5), "p95": percentile(light_latencies, .95),
+            "max": max(light_latencies), "total": time.monotonic() - started_at}
+
+
+def main() -> None:
+    config.warmup_text = ""
+    config.clip_cache_memory_size = config.clip_cache_disk_size = 0  # every clip is synthesized
+    config.user_max_queued_jobs = HEAVY_JOBS
+    total_clips = HEAVY_USERS * HEAVY_JOBS * HEAVY_CLIPS + LIGHT_USERS
+    print(f"{HEAVY_USERS * HEAVY_JOBS} jobs of {HEAVY_CLIPS} clips and {LIGHT_USERS} one-clip jobs every "
+          f"{LIGHT_INTERVAL:.2f}s, {total_clips} clips of {CLIP_TIME:.2f}s on one worker")
+    print(f"{'mode':<14}{'short p50':>11}{'short p95':>11}{'short max':>11}{'all done':>10}")
+    for mode, max_batch_jobs in (("one by one", 1), ("interleaved", 4)):
+        result = run_workload(max_batch_jobs)
+        print(f"{mode:<14}{result['p50']:>10.2f}s{result['p95']:>10.2f}s{result['max']:>10.2f}s{result['total']:>9.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+import pytest
+from voice_bot.modules.bot_utils import config
+from voice_bot.modules.tts_queue import TTSJobQueue
+
+
+@pytest.fixture(autouse=True)
+def test_config(monkeypatch):
+    """no batch window, warm-up and clip caching, so that tests don't wait or write into bot data"""
+    monkeypatch.setattr(config, "batch_window", 0)
+    monkeypatch.setattr(config, "warmup_text", "")
+    monkeypatch.setattr(config, "clip_cache_memory_size", 0)
+    monkeypatch.setattr(config, "clip_cache_disk_size", 0)
+    return config
+
+
+@pytest.fixture
+def queue(test_config, monkeypatch):
+    """job queue of a single test, limits don't get in the way unless the test sets them"""
+    monkeypatch.setattr(test_config, "queue_max_size", 100)
+    monkeypatch.setattr(test_config, "user_max_queued_jobs", 10)
+    monkeypatch.setattr(test_config, "user_max_active_jobs", 10)
+    return TTSJobQueue()
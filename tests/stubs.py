@@ -0,0 +1,41 @@
+import time
+from threading import Lock
+from types import SimpleNamespace
+from typing import List
+import torch
+from voice_bot.modules.tts_queue import TTSJob
+from voice_bot.modules.voice_cache import RANDOM_VOICE
+
+
+# long enough for the text splitter to keep every sentence as a separate clip
+CLIP_SENTENCE = ("This sentence stands in for a single clip of a synthesis request, it is long enough "
+                 "to be kept on its own by the splitter, so clips are counted by sentences.")
+CLIP_SAMPLES = 240  # pcm samples of a synthesized stub clip
+
+
+def make_job(user_id: int, clips: int = 1, samples: int = 1, voice: str = RANDOM_VOICE) -> TTSJob:
+    """job of a user with the given number of clips, workspace isn't created on disk"""
+    settings = SimpleNamespace(voice=voice, emotion=None, samples_num=samples)
+    workspace = SimpleNamespace(path=f"stub_job_{user_id}_{time.monotonic_ns()}")
+    return TTSJob(SimpleNamespace(id=user_id), workspace, " ".join([CLIP_SENTENCE] * clips), settings, None)
+
+
+class StubBackend(object):
+    """
+    synthesis backend without a model, takes clip_time seconds per clip of a batch,
+    records synthesized batches, same interface as TortoiseBackend and ProcessBackend
+    """
+    def __init__(self, device: int, clip_time: float = 0.) -> None:
+        self.device = device
+        self.clip_time = clip_time
+        self.batches: List[List[str]] = []
+        self.lock = Lock()
+
+    def prebake_default_voices(self) -> None:
+        pass
+
+    def synthesize(self, texts: List[str], voice: str, user_voices_dir: str, candidates: List[int], preset: str) -> List[List[torch.Tensor]]:
+        time.sleep(self.clip_time * len(texts))
+        with self.lock:
+            self.batches.append(texts)
+        return [[torch.zeros(1, CLIP_SAMPLES) for _ in range(text_candidates)] for text_candidates in candidates]
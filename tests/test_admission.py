@@ -0,0 +1,94 @@
+import pytest
+import voice_bot.modules.bot_utils as bot_utils
+from voice_bot.modules.bot_utils import AdmissionControl, TokenBucket
+
+
+class FakeClock(object):
+    """time module replacement with manually advanced monotonic time"""
+    def __init__(self) -> None:
+        self.now = 1000.
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(bot_utils, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def admission(test_config, clock, monkeypatch):
+    monkeypatch.setattr(test_config, "cost_chars", 100)
+    monkeypatch.setattr(test_config, "user_rate", 1.)
+    monkeypatch.setattr(test_config, "user_burst", 4.)
+    monkeypatch.setattr(test_config, "global_rate", 10.)
+    monkeypatch.setattr(test_config, "global_burst", 10.)
+    return AdmissionControl()
+
+
+def test_bucket_refill(clock):
+    bucket = TokenBucket(2., 10.)
+    bucket.tokens = 0.
+    clock.now += 3
+    bucket.refill(clock.now)
+    assert bucket.tokens == pytest.approx(6.)
+    assert bucket.get_wait_time(8.) == pytest.approx(1.)
+    clock.now += 100
+    bucket.refill(clock.now)
+    assert bucket.is_full() and bucket.tokens == 10.
+
+
+def test_bucket_cost_above_burst(clock):
+    bucket = TokenBucket(1., 5.)
+    assert bucket.get_wait_time(50.) == 0.
+    bucket.tokens = 4.
+    assert bucket.get_wait_time(50.) == pytest.approx(1.)
+
+
+def test_cost(admission):
+    assert admission.get_cost(0, 1) == 1
+    assert admission.get_cost(100, 1) == 1
+    assert admission.get_cost(101, 1) == 2
+    assert admission.get_cost(250, 3) == 9
+
+
+def test_user_burst_and_rate(admission, clock):
+    assert admission.try_admit(1, 3) == 0.
+    assert admission.try_admit(1, 1) == 0.
+    assert admission.try_admit(1, 2) == pytest.approx(2.)
+    clock.now += 1
+    assert admission.try_admit(1, 2) == pytest.approx(1.)
+    clock.now += 1
+    assert admission.try_admit(1, 2) == 0.
+    # rejected requests don't consume tokens
+    assert admission.user_buckets[1].tokens == pytest.approx(0.)
+
+
+def test_users_limited_separately(admission):
+    assert admission.try_admit(1, 4) == 0.
+    assert admission.try_admit(1, 1) > 0
+    assert admission.try_admit(2, 4) == 0.
+
+
+def test_global_limit(admission, clock):
+    assert admission.try_admit(1, 4) == 0.
+    assert admission.try_admit(2, 4) == 0.
+    # new user has a full bucket, but all users together are out of tokens
+    assert admission.try_admit(3, 4) == pytest.approx(0.2)
+    assert admission.user_buckets[3].is_full()
+    clock.now += 0.2
+    assert admission.try_admit(3, 4) == 0.
+
+
+def test_prune_idle_users(admission, clock, monkeypatch):
+    monkeypatch.setattr(bot_utils, "ADMISSION_PRUNE_SIZE", 2)
+    admission.prune_size = 2
+    admission.try_admit(1, 4)
+    admission.try_admit(2, 1)
+    clock.now += 1  # user 2 bucket is full again, user 1 is not
+    admission.try_admit(3, 1)
+    assert set(admission.user_buckets) == {1, 3}
+    assert admission.prune_size == 2
@@ -0,0 +1,102 @@
+from typing import List
+import pytest
+from voice_bot.modules.batch_sizer import BUCKET_TOKENS, GROW_AFTER, BatchSizer
+
+
+class FakeBackend(object):
+    """runs batches of rows, runs out of memory when batch tokens exceed the limit, like a model on a small GPU"""
+    def __init__(self, max_tokens: int) -> None:
+        self.max_tokens = max_tokens
+        self.done: List[int] = []
+        self.batches: List[int] = []  # sizes of successful batches
+        self.ooms = 0
+        self.memory_freed = 0
+
+    def run_batch(self, rows: List[int]) -> None:
+        if sum(rows) > self.max_tokens:
+            self.ooms += 1
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        self.done.extend(rows)
+        self.batches.append(len(rows))
+
+    def empty_cache(self) -> None:
+        self.memory_freed += 1
+
+
+def run(sizer: BatchSizer, backend: FakeBackend, rows: List[int]) -> None:
+    sizer.run(rows, rows, backend.run_batch)  # row is its input length
+
+
+def test_oom_batches_are_retried_smaller():
+    backend = FakeBackend(max_tokens=30)
+    sizer = BatchSizer(16, on_oom=backend.empty_cache)
+    rows = [10] * 16
+
+    run(sizer, backend, rows)
+
+    assert backend.done == rows
+    assert max(backend.batches) <= 3
+    assert backend.ooms == backend.memory_freed > 0
+
+
+def test_found_size_is_kept_for_the_bucket():
+    backend = FakeBackend(max_tokens=40)
+    sizer = BatchSizer(16, on_oom=backend.empty_cache)
+    run(sizer, backend, [10] * 16)
+    ooms = backend.ooms
+
+    run(sizer, backend, [10] * 16)
+
+    assert backend.ooms == ooms
+    assert sizer.get_size(10) == 4
+
+
+def test_buckets_are_sized_separately():
+    backend = FakeBackend(max_tokens=64)
+    sizer = BatchSizer(8, on_oom=backend.empty_cache)
+    short, long = [4] * 8, [4 * BUCKET_TOKENS] * 8
+
+    run(sizer, backend, short + long)
+
+    assert backend.done == short + long
+    assert sizer.get_size(4) == 8
+    assert sizer.get_size(4 * BUCKET_TOKENS) == 1
+
+
+def test_larger_size_is_probed_after_successes():
+    backend = FakeBackend(max_tokens=20)
+    sizer = BatchSizer(4, on_oom=backend.empty_cache)
+    run(sizer, backend, [10] * 4)
+    assert sizer.get_size(10) == 2
+
+    # memory is freed by something else, larger batches fit now
+    backend.max_tokens = 30
+    run(sizer, backend, [10] * 2 * GROW_AFTER)
+    assert sizer.get_size(10) == 3
+    ooms = backend.ooms
+
+    # failed probe falls back to the size known to work
+    run(sizer, backend, [10] * 4 * GROW_AFTER)
+    assert backend.ooms == ooms + 1
+    assert sizer.get_size(10) == 3
+
+
+def test_single_row_oom_is_raised():
+    backend = FakeBackend(max_tokens=5)
+    sizer = BatchSizer(4, on_oom=backend.empty_cache)
+
+    with pytest.raises(RuntimeError, match="out of memory"):
+        run(sizer, backend, [10] * 4)
+    assert sizer.get_size(10) == 1
+
+
+def test_other_errors_are_not_retried():
+    calls = []
+
+    def run_batch(rows: List[int]) -> None:
+        calls.append(rows)
+        raise ValueError("bad input")
+
+    with pytest.raises(ValueError):
+        BatchSizer(4).run([1, 2, 3], [1, 2, 3], run_batch)
+    assert len(calls) == 1
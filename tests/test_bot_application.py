@@ -0,0 +1,87 @@
+import time
+import asyncio
+import datetime
+from typing import Dict, List
+from telegram import Bot, Chat, Message, Update, User
+from telegram.ext import ApplicationBuilder, TypeHandler
+from voice_bot.modules.bot_application import ChatOrderedApplication
+
+
+CONCURRENT_UPDATES = 4
+FLOOD_UPDATES = 32
+HANDLER_TIME = 0.05
+
+
+class OfflineBot(Bot):
+    """bot that doesn't call telegram api on initialization"""
+    async def initialize(self) -> None:
+        pass
+
+
+def make_update(update_id: int, chat_id: int) -> Update:
+    user = User(chat_id, f"user {chat_id}", False)
+    message = Message(update_id, datetime.datetime.now(), Chat(chat_id, Chat.PRIVATE), from_user=user, text=str(update_id))
+    return Update(update_id, message=message)
+
+
+async def feed_updates(updates: List[Update], handle) -> None:
+    """run the application with the handler until the updates are processed"""
+    application = (ApplicationBuilder()
+                   .application_class(ChatOrderedApplication)
+                   .bot(OfflineBot("123:TOKEN"))
+                   .updater(None)
+                   .concurrent_updates(CONCURRENT_UPDATES)
+                   .build())
+    application.add_handler(TypeHandler(Update, handle))
+    async with application:
+        await application.start()
+        for update in updates:
+            await application.update_queue.put(update)
+        await application.update_queue.join()
+        await application.stop()
+
+
+async def run_updates(updates: List[Update]) -> Dict[int, List[tuple]]:
+    """feed updates to the application, returns {chat_id: [(update_id, handled_at)]} in order of handling"""
+    handled: Dict[int, List[tuple]] = {}
+
+    async def handle(update: Update, context) -> None:
+        await asyncio.sleep(HANDLER_TIME)
+        handled.setdefault(update.effective_chat.id, []).append((update.update_id, time.monotonic()))
+
+    await feed_updates(updates, handle)
+    return handled
+
+
+def test_chat_updates_in_order():
+    updates = [make_update(ind, 1 + ind % 2) for ind in range(10)]
+    handled = asyncio.run(run_updates(updates))
+    assert [update_id for update_id, _ in handled[1]] == list(range(0, 10, 2))
+    assert [update_id for update_id, _ in handled[2]] == list(range(1, 10, 2))
+
+
+def test_flooding_chat_doesnt_delay_others():
+    started_at = time.monotonic()
+    updates = [make_update(ind, 1) for ind in range(FLOOD_UPDATES)]
+    updates += [make_update(FLOOD_UPDATES + ind, 2 + ind) for ind in range(CONCURRENT_UPDATES)]
+    handled = asyncio.run(run_updates(updates))
+    assert [update_id for update_id, _ in handled[1]] == list(range(FLOOD_UPDATES))
+    # updates of the flooding chat are handled one by one, others get free slots right away
+    for ind in range(CONCURRENT_UPDATES):
+        _, handled_at = handled[2 + ind][0]
+        assert handled_at - started_at < HANDLER_TIME * 4
+    assert handled[1][-1][1] - started_at >= HANDLER_TIME * FLOOD_UPDATES
+
+
+def test_concurrent_updates_are_limited():
+    running, max_running = 0, 0
+
+    async def handle(update: Update, context) -> None:
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(HANDLER_TIME)
+        running -= 1
+
+    asyncio.run(feed_updates([make_update(ind, ind) for ind in range(CONCURRENT_UPDATES * 4)], handle))
+    assert max_running == CONCURRENT_UPDATES
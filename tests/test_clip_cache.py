@@ -0,0 +1,14 @@
+import torch
+from voice_bot.modules.clip_cache import ClipCache
+
+
+def test_shared_memory_clips_are_copied(test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "clip_cache_memory_size", 1024 * 1024)
+    cache = ClipCache()
+    audio = torch.ones(1, 240).share_memory_()  # as received from backend process
+
+    cache.put("key", audio)
+
+    cached = cache.get("key")
+    assert not cached.is_shared()
+    assert torch.equal(cached, audio)
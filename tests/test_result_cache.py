@@ -0,0 +1,18 @@
+import voice_bot.modules.result_cache as result_cache_module
+from voice_bot.modules.result_cache import ResultCache
+
+
+def test_known_file_ids_dont_rewrite_index(test_config, tmp_path, monkeypatch):
+    monkeypatch.setattr(result_cache_module, "RESULT_CACHE_PATH", str(tmp_path))
+    monkeypatch.setattr(test_config, "result_cache_size", 1024 * 1024)
+    cache = ResultCache()
+    saves = []
+    monkeypatch.setattr(cache, "save_index", lambda: saves.append(list(cache.entries.items())))
+    cache.put("key", [b"first", b"second"])
+
+    cache.set_file_ids("key", ["id1", "id2"])
+    cache.set_file_ids("key", ["id1", "id2"])  # cache hit re-sent by file ids
+    cache.set_file_ids("key", [None, "id2"])
+
+    assert len(saves) == 2
+    assert cache.get("key") == ["id1", "id2"]
@@ -0,0 +1,38 @@
+import time
+import multiprocessing
+from threading import Lock
+import pytest
+from voice_bot.modules.tts_process import ProcessBackend
+
+
+class PipeBackend(ProcessBackend):
+    """process backend talking to the other end of a pipe instead of a child process"""
+    def __init__(self) -> None:
+        self.device = 0
+        self.lock = Lock()
+        self.conn, self.child_conn = multiprocessing.Pipe()
+        self.restarts = []
+
+    def restart_process(self, reason: str) -> None:
+        self.restarts.append(reason)
+
+
+def test_hung_process_is_restarted(test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "backend_clip_timeout", 0.1)
+    backend = PipeBackend()
+    started_at = time.monotonic()
+
+    with pytest.raises(Exception, match="timed out"):
+        backend.synthesize(["text"], "random", None, [2])
+
+    assert 0.2 <= time.monotonic() - started_at < 2
+    assert len(backend.restarts) == 1
+    assert backend.child_conn.recv()[0] == "synthesize"
+
+
+def test_reply_in_time_is_returned():
+    backend = PipeBackend()
+    backend.child_conn.send(("ok", 42))
+
+    assert backend.call("prebake_default_voices", timeout=1) == 42
+    assert not backend.restarts
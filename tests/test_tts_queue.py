@@ -0,0 +1,130 @@
+import time
+from threading import Thread
+import pytest
+from voice_bot.modules.tts_queue import JobCancelledError, QueueFullError
+from tests.stubs import make_job
+
+
+def test_jobs_are_taken_round_robin_between_users(queue):
+    jobs = [make_job(1), make_job(1), make_job(1), make_job(2), make_job(3)]
+    for job in jobs:
+        queue.put(job)
+
+    batch = queue.get_batch(5, block=False)
+
+    assert [job.user_id for job in batch] == [1, 2, 3, 1, 1]
+    assert queue.size == 0
+
+
+def test_user_active_jobs_are_capped(queue, test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "user_max_active_jobs", 1)
+    first, second, other = make_job(1), make_job(1), make_job(2)
+    for job in (first, second, other):
+        queue.put(job)
+
+    assert queue.get_batch(3, block=False) == [first, other]
+    assert queue.get_batch(3, block=False) == []
+    queue.task_done(first)
+    assert queue.get_batch(3, block=False) == [second]
+
+
+def test_admission_is_rejected_when_queue_is_full(queue, test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "queue_max_size", 2)
+    monkeypatch.setattr(test_config, "user_max_queued_jobs", 1)
+    queue.put(make_job(1))
+
+    with pytest.raises(QueueFullError) as user_full:
+        queue.put(make_job(1))
+    queue.put(make_job(2))
+    with pytest.raises(QueueFullError) as queue_full:
+        queue.put(make_job(3))
+
+    assert user_full.value.user_limit
+    assert not queue_full.value.user_limit
+    assert queue.size == 2
+
+
+def test_position_follows_take_order(queue):
+    heavy_first, heavy_second, light = make_job(1, clips=5), make_job(1, clips=5), make_job(2)
+    for job in (heavy_first, heavy_second, light):
+        queue.put(job)
+
+    positions = [queue.get_position(job) for job in (heavy_first, light, heavy_second)]
+
+    assert [place for place, _ in positions] == [1, 2, 3]
+    assert positions[0][1] < positions[1][1] < positions[2][1]
+    queue.get_batch(1, block=False)
+    assert queue.get_position(heavy_first) == (0, 0.)
+    assert queue.get_position(light)[0] == 1
+
+
+def test_cancelled_queued_job_is_removed(queue):
+    cancelled, kept = make_job(1), make_job(2)
+    queue.put(cancelled)
+    queue.put(kept)
+
+    assert queue.cancel(cancelled)
+
+    with pytest.raises(JobCancelledError):
+        cancelled.future.result(timeout=0)
+    assert queue.size == 1
+    assert queue.get_batch(2, block=False) == [kept]
+
+
+def test_cancelled_running_job_is_marked_for_worker(queue):
+    job = make_job(1)
+    queue.put(job)
+    queue.get_batch(1, block=False)
+
+    assert queue.cancel(job)
+    assert job.cancelled
+    job.future.set_result(None)
+    assert not queue.cancel(job)
+
+
+def test_batch_window_is_not_cut_short_by_new_jobs(queue, test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "batch_window", 0.2)
+    first, second = make_job(1), make_job(2)
+    queue.put(first)
+    result = []
+    started_at = time.monotonic()
+    getter = Thread(target=lambda: result.append((queue.get_batch(2), time.monotonic() - started_at)))
+    getter.start()
+    time.sleep(0.05)
+    queue.put(second)  # notifies the waiting getter
+    getter.join(timeout=5)
+
+    batch, waited = result[0]
+    assert batch == [first, second]
+    assert waited >= 0.2
+
+
+def test_quality_is_not_lowered_before_clip_time_is_measured(queue):
+    jobs = [make_job(1 + ind % 3, clips=3, samples=3) for ind in range(7)]
+    for job in jobs:
+        queue.put(job)
+
+    queue.get_batch(7, block=False)
+
+    assert [job.quality for job in jobs] == ["normal"] * 7
+    assert [job.candidates for job in jobs] == [3] * 7
+
+
+def test_backlog_is_shared_by_workers(queue, test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "quality_low_wait", 120)
+    jobs = [make_job(1 + ind % 3, clips=3, samples=3) for ind in range(7)]
+    for job in jobs:
+        queue.put(job)
+    queue.report_clip_time(10.)
+    queue.set_workers(2)
+
+    assert queue.get_backlog_time() == pytest.approx(7 * 3 * 10. / 2)
+    # two jobs ahead are shared by workers, own clips run on one of them
+    assert queue.get_position(jobs[2])[1] == pytest.approx((2 * 3 / 2 + 3) * 10.)
+    queue.get_batch(7, block=False)
+    assert [job.quality for job in jobs] == ["normal"] * 7
+
+    queue.set_workers(1)
+    for job in jobs:
+        queue.put(make_job(job.user_id, clips=3))
+    assert queue.get_batch(1, block=False)[0].quality == "low"
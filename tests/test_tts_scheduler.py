@@ -0,0 +1,137 @@
+import time
+from typing import Dict, List
+import pytest
+from voice_bot.modules.tts_queue import QueueClosedError, TTSJobQueue
+from voice_bot.modules.tts_scheduler import TTSWorkerPool
+from tests.stubs import CLIP_SAMPLES, StubBackend, make_job
+
+
+CLIP_TIME = 0.05
+
+
+@pytest.fixture
+def start_pool():
+    """starts pools of stub backends, they are stopped after the test"""
+    pools = []
+
+    def start(queue, devices: List[int], clip_time: float = CLIP_TIME, failing: tuple = ()) -> Dict[int, StubBackend]:
+        """start a pool and wait for its workers to get ready or fail, returns backends by device"""
+        backends = {}
+
+        def backend_factory(device: int) -> StubBackend:
+            if device in failing:
+                raise Exception(f"no device {device}")
+            backends[device] = StubBackend(device, clip_time)
+            return backends[device]
+
+        pool = TTSWorkerPool(backend_factory, queue)
+        pools.append(pool)
+        pool.start(devices)
+        deadline = time.monotonic() + 5
+        while not all(worker.scheduler is not None or worker.failed for worker in pool.workers):
+            assert time.monotonic() < deadline, "workers are not ready"
+            time.sleep(0.01)
+        return backends
+
+    yield start
+    for pool in pools:
+        pool.stop(timeout=5)
+        assert not any(worker.is_alive() for worker in pool.workers)
+
+
+def run_jobs(queue, jobs: list) -> float:
+    """put jobs and wait for all of them, returns elapsed time"""
+    started_at = time.monotonic()
+    for job in jobs:
+        queue.put(job)
+    for job in jobs:
+        job.future.result(timeout=10)
+    return time.monotonic() - started_at
+
+
+def test_clips_of_job_are_combined_for_every_sample(queue, start_pool):
+    start_pool(queue, [0], clip_time=0)
+    job = make_job(1, clips=3, samples=2)
+
+    run_jobs(queue, [job])
+
+    assert len(job.result_audio) == 2
+    assert all(audio.shape == (3 * CLIP_SAMPLES,) for audio in job.result_audio)
+    assert not queue.active
+
+
+def test_jobs_are_spread_over_workers(queue, start_pool):
+    backends = start_pool(queue, [0, 1, 2, 3])
+
+    run_jobs(queue, [make_job(user_id) for user_id in range(16)])
+
+    assert sorted(backends) == [0, 1, 2, 3]
+    assert all(backend.batches for backend in backends.values())
+    assert sum(len(texts) for backend in backends.values() for texts in backend.batches) == 16
+    assert queue.workers == 4
+
+
+@pytest.mark.parametrize("workers", [2, 4])
+def test_throughput_scales_with_workers(queue, start_pool, workers):
+    start_pool(queue, [0])
+    single_elapsed = run_jobs(queue, [make_job(user_id) for user_id in range(16)])
+    pool_queue = TTSJobQueue()
+    start_pool(pool_queue, list(range(workers)))
+
+    pool_elapsed = run_jobs(pool_queue, [make_job(user_id) for user_id in range(16)])
+
+    # near-linear, with some slack for thread scheduling
+    assert pool_elapsed < single_elapsed / workers * 1.5
+
+
+def test_other_workers_serve_if_device_fails(queue, start_pool):
+    backends = start_pool(queue, [0, 1], failing=(1,))
+
+    run_jobs(queue, [make_job(user_id) for user_id in range(4)])
+
+    assert list(backends) == [0]
+    assert queue.workers == 1
+
+
+def test_first_part_of_progressive_job_is_delivered_after_one_clip(queue, start_pool):
+    backends = start_pool(queue, [0], clip_time=0.01)
+    job = make_job(1, clips=6)
+    parts = []
+    job.clip_callback = lambda start, end, pcm: parts.append((start, end, backends[0].batches[:]))
+
+    run_jobs(queue, [job])
+
+    first_start, first_end, batches_before = parts[0]
+    assert (first_start, first_end) == (0, 1)
+    assert [len(texts) for texts in batches_before] == [1]
+    assert parts[-1][1] == 6
+
+
+def test_jobs_fail_if_no_worker_starts(queue, start_pool):
+    queued = make_job(1)
+    queue.put(queued)
+
+    start_pool(queue, [0, 1], failing=(0, 1))
+
+    with pytest.raises(QueueClosedError):
+        queued.future.result(timeout=1)
+    with pytest.raises(QueueClosedError):
+        queue.put(make_job(2))
+
+
+def test_stopped_pool_fails_running_jobs(queue, test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "round_clips", 1)
+    pool = TTSWorkerPool(lambda device: StubBackend(device, CLIP_TIME), queue)
+    pool.start([0])
+    running, queued = make_job(1, clips=20), make_job(1)
+    queue.put(running)
+    queue.put(queued)
+    while running.started_at is None:
+        time.sleep(0.01)
+
+    pool.stop(timeout=5)
+
+    for job in (running, queued):
+        with pytest.raises(QueueClosedError):
+            job.future.result(timeout=0)
+    assert not pool.workers[0].is_alive()
@@ -3,9 +3,11 @@ from telegram.ext import (
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters
 )
-from telegram import Bot, request
+from telegram import Bot, Update, request
+import time
 import asyncio
 import os.path
 from voice_bot.modules.bot_handlers import (
@@ -15,11 +17,21 @@ from voice_bot.modules.bot_handlers import (
     gen_audio_inline,
     gen_audio_from_voice,
     retry_button,
+    cancel_button,
     error_handler,
+    log_first_update,
     toggle_inline_cmd,
     QUERY_PATTERN_RETRY,
-    tts_work_thread
+    QUERY_PATTERN_CANCEL
 )
+from voice_bot.modules.tts_scheduler import tts_worker_pool
+from voice_bot.modules.result_cache import result_cache
+from voice_bot.modules.clip_cache import clip_cache
+from voice_bot.modules.bot_db import reconcile_voices
+from voice_bot.modules.bot_settings import settings_cache
+from voice_bot.modules.bot_application import ChatOrderedApplication
+from voice_bot.modules.whisper_api import preload_model
+from voice_bot.modules.workspace import run_janitor
 from voice_bot.modules.bot_settings_menu import get_settings_menu_handler
 from voice_bot.modules.bot_voice_addition_menu import get_add_voice_menu_handler
 import voice_bot.modules.bot_utils as utils
@@ -28,14 +40,17 @@ import voice_bot.modules.bot_utils as utils
 def initialize_bot_data() -> None:
     utils.config.load_config(os.path.join(utils.DATA_PATH, utils.CONFIG_FILE_NAME))
     utils.FOLDER_CHAR_LIMIT = os.statvfs(utils.VOICES_PATH).f_namemax
+    result_cache.load_index()
+    clip_cache.load_index()
 
 
-def init_http_request() -> request.HTTPXRequest:
-    return request.HTTPXRequest(http_version="1.1", connection_pool_size=8, read_timeout=30, write_timeout=30)
+def init_http_request(pool_size: int = 8) -> request.HTTPXRequest:
+    return request.HTTPXRequest(http_version="1.1", connection_pool_size=pool_size, read_timeout=30, write_timeout=30)
 
 
 async def init_bot_settings() -> Bot:
-    bot = Bot(utils.config.token, request=init_http_request(),
+    # updates are handled concurrently, so each of them may need a connection
+    bot = Bot(utils.config.token, request=init_http_request(max(8, utils.config.concurrent_updates)),
               get_updates_request=init_http_request())
     cmds = [("gen", "Synthesize audio from provided text"),
             ("add_voice", "Add your custom voice"),
@@ -55,10 +70,25 @@ def create_bot() -> Bot:
     return task.result()
 
 
+async def post_init(application: Application) -> None:
+    # models are loaded and voices reconciled in background, bot is serving in the meantime
+    tts_worker_pool.start(utils.config.devices)
+    preload_model()
+    application.create_task(reconcile_voices(settings_cache.invalidate))
+    application.create_task(run_janitor())
+    utils.logger.info(f"Bot is starting to serve in {time.monotonic() - utils.STARTED_AT:.1f}s since start")
+
+
 def run_application() -> None:
 
-    application = Application.builder().bot(create_bot()).build()
+    application = (Application.builder()
+                   .application_class(ChatOrderedApplication)
+                   .bot(create_bot())
+                   .concurrent_updates(max(utils.config.concurrent_updates, 1))
+                   .post_init(post_init)
+                   .build())
 
+    application.add_handler(TypeHandler(Update, log_first_update), group=-1)
     application.add_handler(CommandHandler("start", start_cmd))
     application.add_handler(CommandHandler("gen", gen_audio_cmd))
     application.add_handler(CommandHandler("toggle_inline", toggle_inline_cmd))
@@ -66,13 +96,12 @@ def run_application() -> None:
     application.add_handler(get_settings_menu_handler())
     application.add_handler(get_add_voice_menu_handler())
     application.add_handler(CallbackQueryHandler(retry_button, pattern=f"^{QUERY_PATTERN_RETRY}*"))
+    application.add_handler(CallbackQueryHandler(cancel_button, pattern=f"^{QUERY_PATTERN_CANCEL}"))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, gen_audio_inline))
     application.add_handler(MessageHandler(filters.VOICE & ~filters.COMMAND, gen_audio_from_voice))
 
     application.add_error_handler(error_handler)
 
-    tts_work_thread.start()
-
     application.run_polling()
 
 
@@ -0,0 +1,85 @@
+from threading import Lock
+from typing import Callable, Dict, List, Sequence
+from voice_bot.modules.bot_utils import logger
+
+
+BUCKET_TOKENS = 16  # width of input length bucket
+GROW_AFTER = 32  # successful batches of a bucket before a larger batch size is probed
+
+
+def is_oom_error(e: BaseException) -> bool:
+    """torch raises allocation failures as RuntimeError (OutOfMemoryError subclass in newer versions)"""
+    return isinstance(e, RuntimeError) and "out of memory" in str(e)
+
+
+class BatchSizer(object):
+    """
+    Picks batch size for each input length bucket, starting from max_size,
+    halves it when a batch runs out of memory and retries the batch,
+    best size found for a bucket is kept, so that later batches start with it,
+    larger size is probed again after a run of successful batches
+    """
+    def __init__(self, max_size: int, on_oom: Callable[[], None] = lambda: None) -> None:
+        self.max_size = max(max_size, 1)
+        self.on_oom = on_oom  # frees memory before retrying
+        self.sizes: Dict[int, int] = {}  # bucket: batch size
+        self.successes: Dict[int, int] = {}  # bucket: batches done since the last change
+        self.good_sizes: Dict[int, int] = {}  # bucket: largest size that succeeded
+        self.lock = Lock()
+
+    @staticmethod
+    def get_bucket(length: int) -> int:
+        return length // BUCKET_TOKENS
+
+    def get_size(self, length: int) -> int:
+        with self.lock:
+            return self.sizes.get(self.get_bucket(length), self.max_size)
+
+    def report_success(self, length: int, size: int) -> None:
+        bucket = self.get_bucket(length)
+        with self.lock:
+            current = self.sizes.get(bucket, self.max_size)
+            if size < current:  # partial last batch, says nothing about larger ones
+                return
+            self.successes[bucket] = self.successes.get(bucket, 0) + 1
+            self.good_sizes[bucket] = max(self.good_sizes.get(bucket, 0), size)
+            if current < self.max_size and self.successes[bucket] >= GROW_AFTER:
+                self.sizes[bucket] = current + 1
+                self.successes[bucket] = 0
+
+    def report_oom(self, length: int, size: int) -> int:
+        """returns batch size to retry with"""
+        bucket = self.get_bucket(length)
+        with self.lock:
+            good_size = self.good_sizes.get(bucket, 0)
+            if good_size >= size:  # good size no longer fits, e.g. memory is fragmented
+                good_size = self.good_sizes[bucket] = 0
+            # failed probe of a larger size falls back to the good one
+            new_size = max(min(self.sizes.get(bucket, self.max_size), size // 2), good_size, 1)
+            self.sizes[bucket] = new_size
+            self.successes[bucket] = 0
+        logger.warning(f"Out of memory with batch size {size} for inputs of length {length}, retrying with {new_size}")
+        return new_size
+
+    def run(self, rows: List, lengths: Sequence[int], run_batch: Callable[[List], None]) -> None:
+        """
+        run_batch on consecutive batches of rows, lengths - input length of every row,
+        rows are expected to be sorted by length, so that a batch is bucketed by its last row
+        raises when a batch of a single row runs out of memory
+        """
+        start = 0
+        while start < len(rows):
+            size = self.get_size(lengths[start])
+            size = min(size, self.get_size(lengths[min(start + size, len(rows)) - 1]))
+            end = min(start + size, len(rows))
+            length = lengths[end - 1]
+            try:
+                run_batch(rows[start:end])
+            except Exception as e:
+                if not is_oom_error(e) or end - start == 1:
+                    raise
+                self.on_oom()
+                self.report_oom(length, end - start)
+                continue
+            self.report_success(length, end - start)
+            start = end
@@ -0,0 +1,55 @@
+import asyncio
+from typing import Dict, Optional, Union
+from telegram import Update
+from telegram.ext import Application
+
+
+UNBOUNDED_UPDATES = 1 << 16  # limit passed to the base application, the real one is applied after the chat turn
+
+
+class ChatOrderedApplication(Application):
+    """
+    Application for concurrent updates processing, updates of different chats are handled concurrently,
+    while updates of the same chat (or user if there is no chat) are handled one by one in order of arrival,
+    so that conversation menus see them in order,
+    concurrent_updates limit is applied to updates whose chat turn has come, instead of the base application limit,
+    so that updates waiting for their chat don't take the slots and a flooding chat doesn't delay others
+    """
+    def __init__(self, *, concurrent_updates: Union[bool, int], **kwargs) -> None:
+        if concurrent_updates is True:
+            concurrent_updates = 256  # same as the base application
+        super().__init__(concurrent_updates=UNBOUNDED_UPDATES, **kwargs)
+        self.update_slots = asyncio.Semaphore(max(int(concurrent_updates), 1))
+        self.chat_locks: Dict[int, asyncio.Lock] = {}
+        self.chat_waiters: Dict[int, int] = {}
+
+    async def process_update(self, update: object) -> None:
+        key = self.get_order_key(update)
+        if key is None:
+            async with self.update_slots:
+                await super().process_update(update)
+            return
+
+        lock = self.chat_locks.get(key, None)
+        if lock is None:
+            lock = self.chat_locks[key] = asyncio.Lock()
+        self.chat_waiters[key] = self.chat_waiters.get(key, 0) + 1
+        try:
+            async with lock:  # lock waiters are woken up in fifo order
+                async with self.update_slots:
+                    await super().process_update(update)
+        finally:
+            self.chat_waiters[key] -= 1
+            if not self.chat_waiters[key]:  # drop locks of idle chats
+                del self.chat_waiters[key]
+                del self.chat_locks[key]
+
+    @staticmethod
+    def get_order_key(update: object) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
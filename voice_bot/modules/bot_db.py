@@ -1,7 +1,9 @@
 import sqlite3
 import os
-from typing import List
-from voice_bot.modules.bot_utils import DATA_PATH, VOICES_PATH
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+from voice_bot.modules.bot_utils import DATA_PATH, VOICES_PATH, VOICES_SHARDS, get_voices_shard, get_voices_shard_name, logger
 import shutil
 
 
@@ -9,11 +11,13 @@ DB_NAME = "bot.db"
 DB_PATH = os.path.join(DATA_PATH, DB_NAME)
 USERS_TABLE = "users"
 VOICES_TABLE = "voices"
+MANIFEST_TABLE = "voices_manifest"
 DEFAULT_DEFAULT_VOICE = "train_dotrice"
 CREATE_USERS_TABLE = f"""CREATE TABLE "{USERS_TABLE}" (
 "uid"	INTEGER NOT NULL,
 "emotion_type"	INTEGER DEFAULT 0,
 "sample_num"	INTEGER DEFAULT 1,
+"delivery_mode"	INTEGER DEFAULT 0,
 "voice_fid" INTEGER DEFAULT NULL,
 "default_voice" Text DEFAULT "{DEFAULT_DEFAULT_VOICE}",
 PRIMARY KEY("uid"),
@@ -28,25 +32,36 @@ PRIMARY KEY("id"),
 FOREIGN KEY("user_fid") REFERENCES users(uid)
     ON DELETE CASCADE
 )"""
+CREATE_MANIFEST_TABLE = f"""CREATE TABLE IF NOT EXISTS "{MANIFEST_TABLE}" (
+"uid"	INTEGER NOT NULL,
+"mtime_ns"	INTEGER NOT NULL,
+PRIMARY KEY("uid")
+)"""
+VOICES_INDEX = f"{VOICES_TABLE}_user_name_unique"
+CREATE_VOICES_INDEX = f"""CREATE UNIQUE INDEX IF NOT EXISTS "{VOICES_INDEX}" ON "{VOICES_TABLE}" ("user_fid", "name")"""
 
 
 """
 Class that interfaces with sqlite3 database, through which all operations are performed
 Exception catching and handling is reserved for the user (every query can potentially throw)
+Queries are blocking, use db_async from the event loop
 """
 
 
 class DBHandle(object):
-    def __init__(self) -> None:
-        load_existing_db = os.path.exists(DB_PATH)
-        self.conn = sqlite3.connect(DB_PATH)
+    def __init__(self, db_path: str = DB_PATH) -> None:
+        load_existing_db = os.path.exists(db_path)
+        # connection is used by the db thread after initialization on the main thread
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
         self.cursor = self.conn.cursor()
 
         if load_existing_db:
             self.load_db()
         else:
             self.create_db()
-        self.validate_db()
+        self.migrate_voices_layout()
 
     def __del__(self) -> None:
         self.conn.close()
@@ -54,12 +69,33 @@ class DBHandle(object):
     def load_db(self) -> None:
         # check if all tables are in place
         with self.conn:
-            res = self.conn.execute("SELECT name FROM sqlite_master")
-            tables = res.fetchall()  # [(name,)]
-            if USERS_TABLE not in tables[0][0]:
+            res = self.conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
+            tables = set(name for (name,) in res.fetchall())
+            if USERS_TABLE not in tables:
                 self.conn.execute(CREATE_USERS_TABLE)
-            if VOICES_TABLE not in tables[1][0]:
+            if VOICES_TABLE not in tables:
                 self.conn.execute(CREATE_VOICES_TABLE)
+            res = self.conn.execute("SELECT name FROM sqlite_master WHERE type='index'")
+            if VOICES_INDEX not in set(name for (name,) in res.fetchall()):
+                self.dedup_voices()
+            self.conn.execute(CREATE_VOICES_INDEX)
+            self.conn.execute(CREATE_MANIFEST_TABLE)
+            # add columns missing in db created by previous versions
+            res = self.conn.execute(f"PRAGMA table_info({USERS_TABLE})")
+            columns = [column[1] for column in res.fetchall()]  # [(cid, name, type, ...)]
+            if "delivery_mode" not in columns:
+                self.conn.execute(f"ALTER TABLE {USERS_TABLE} ADD COLUMN delivery_mode INTEGER DEFAULT 0")
+
+    def dedup_voices(self) -> None:
+        # keep the first of voices entries with the same user and name (left by earlier versions),
+        # so that the unique index can be created, active voices are moved to the kept entry
+        self.conn.execute(f"""UPDATE {USERS_TABLE} SET voice_fid=(
+            SELECT MIN(same.id) FROM {VOICES_TABLE} AS active
+            JOIN {VOICES_TABLE} AS same ON same.user_fid=active.user_fid AND same.name=active.name
+            WHERE active.id={USERS_TABLE}.voice_fid)
+            WHERE voice_fid IS NOT NULL""")
+        self.conn.execute(f"DELETE FROM {VOICES_TABLE} WHERE id NOT IN (SELECT MIN(id) FROM {VOICES_TABLE} GROUP BY user_fid,name)")
+        self.conn.execute(f'DROP INDEX IF EXISTS "{VOICES_TABLE}_user_name"')
 
     def create_db(self) -> None:
         with self.conn:
@@ -67,69 +103,105 @@ class DBHandle(object):
             self.conn.execute(CREATE_VOICES_TABLE)
         self.load_db()
 
-    def validate_db(self) -> None:
-        # get db tables up-to-date with bot-data (delete voices entries with missing data)
-        # check user folders for integrity
+    def migrate_voices_layout(self) -> None:
+        # move user folders of the flat layout (user_voices/<uid>) into shards (user_voices/shard_xx/<uid>)
+        legacy_dirs = [i for i in os.listdir(VOICES_PATH) if i.isdigit() and os.path.isdir(os.path.join(VOICES_PATH, i))]
+        if not legacy_dirs:
+            return
+        logger.info(f"Moving {len(legacy_dirs)} user voices folders into shards")
+        with self.conn:
+            for dir in legacy_dirs:
+                uid = int(dir)
+                old_path = os.path.join(VOICES_PATH, dir)
+                new_path = os.path.join(VOICES_PATH, get_voices_shard(uid), dir)
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                os.rename(old_path, new_path)
+                self.conn.execute(f"UPDATE {VOICES_TABLE} SET path=? || substr(path, ?) WHERE user_fid=?",
+                                  (new_path, len(old_path) + 1, uid))
+
+    def get_voices_manifest(self) -> Dict[int, int]:
+        # return {uid: mtime_ns} of user voices folders at the last reconciliation
+        res = self.cursor.execute(f"SELECT uid,mtime_ns FROM {MANIFEST_TABLE}")
+        return dict(res.fetchall())
+
+    def reconcile_voices_shard(self, shard: str, manifest: Dict[int, int]) -> Tuple[int, List[int]]:
+        # get voices table up-to-date with user folders of the shard (delete voices entries with missing data),
+        # users whose folder modification time matches the manifest are skipped
+        # manifest - {uid: mtime_ns} of the shard users,
+        # returns number of reconciled users and ids of users whose voice settings were reset
+        shard_path = os.path.join(VOICES_PATH, shard)
+        user_dirs: Dict[int, Tuple[str, int]] = {}  # uid: (path, mtime_ns)
+        if os.path.isdir(shard_path):
+            with os.scandir(shard_path) as it:
+                for entry in it:
+                    if not entry.is_dir():
+                        continue
+                    if not entry.name.isdigit():
+                        shutil.rmtree(entry.path)  # remove not uid named folders
+                        continue
+                    user_dirs[int(entry.name)] = (entry.path, entry.stat().st_mtime_ns)
+
+        changed = [uid for uid, (_, mtime) in user_dirs.items() if manifest.get(uid, None) != mtime]
+        removed = [uid for uid in manifest if uid not in user_dirs]
+        if not changed and not removed:
+            return 0, []
+
+        voices_delete, voices_insert, users_reset = [], [], []
+        for uid in changed + removed:
+            res = self.conn.execute(f"SELECT name FROM {VOICES_TABLE} WHERE user_fid=?", (uid,))
+            user_voices_db = set([name for (name,) in res.fetchall()])
+            voice_dirs = set()
+            if uid in user_dirs:
+                user_voices_path = user_dirs[uid][0]
+                voice_dirs = set([i for i in os.listdir(user_voices_path) if os.path.isdir(os.path.join(user_voices_path, i))])
+            for v in user_voices_db - voice_dirs:
+                voices_delete.append((v, uid))
+                users_reset.append((DEFAULT_DEFAULT_VOICE, uid))
+            for v in voice_dirs - user_voices_db:
+                voices_insert.append((uid, v, os.path.join(user_voices_path, v)))
+
         with self.conn:
-            res = self.conn.execute(f"SELECT uid FROM {USERS_TABLE}")
-            users_db = set([str(uid[0]) for uid in res.fetchall()])
-            users_dirs = [i for i in os.listdir(VOICES_PATH) if os.path.isdir(os.path.join(VOICES_PATH, i))]
-            for dir in users_dirs:
-                if dir not in users_db:
-                    try:
-                        uid = int(dir)
-                    except Exception:
-                        pass
-                    else:
-                        self.conn.execute(f"INSERT INTO {USERS_TABLE} (uid) VALUES ({uid})")
-
-            # check voices for integrity for all users
-            for user_voices_dir in users_dirs:
-                try:
-                    uid = int(user_voices_dir)
-                    user_voices_path = os.path.join(VOICES_PATH, user_voices_dir)
-                except Exception:
-                    shutil.rmtree(user_voices_path)  # remove not uid named folders
-                else:
-                    res = self.conn.execute(f"SELECT name FROM {VOICES_TABLE} WHERE user_fid={uid}")
-                    user_voices_db = set([uid[0] for uid in res.fetchall()])
-                    voice_dirs = set([i for i in os.listdir(user_voices_path) if os.path.isdir(os.path.join(user_voices_path, i))])
-                    for v in user_voices_db - voice_dirs:
-                        self.conn.execute(f"DELETE FROM {VOICES_TABLE} WHERE name='{v}' AND user_fid={uid}")
-                        self.conn.execute(f"UPDATE {USERS_TABLE} SET default_voice='{DEFAULT_DEFAULT_VOICE}',voice_fid=NULL WHERE uid={uid}")
-                    for v in voice_dirs - user_voices_db:
-                        self.conn.execute((f"INSERT INTO {VOICES_TABLE} (user_fid,name,path)"
-                                          f"VALUES ({uid},'{v}','{os.path.join(user_voices_path, v)}')"))
+            self.conn.executemany(f"INSERT OR IGNORE INTO {USERS_TABLE} (uid) VALUES (?)", [(uid,) for uid in changed])
+            self.conn.executemany(f"DELETE FROM {VOICES_TABLE} WHERE name=? AND user_fid=?", voices_delete)
+            self.conn.executemany(f"UPDATE {USERS_TABLE} SET default_voice=?,voice_fid=NULL WHERE uid=?", users_reset)
+            # voice could be added by /add_voice since the folder was listed
+            self.conn.executemany(f"INSERT OR IGNORE INTO {VOICES_TABLE} (user_fid,name,path) VALUES (?,?,?)", voices_insert)
+            self.conn.executemany(f"INSERT OR REPLACE INTO {MANIFEST_TABLE} (uid,mtime_ns) VALUES (?,?)",
+                                  [(uid, user_dirs[uid][1]) for uid in changed])
+            self.conn.executemany(f"DELETE FROM {MANIFEST_TABLE} WHERE uid=?", [(uid,) for uid in removed])
+        return len(changed) + len(removed), sorted(set(uid for _, uid in users_reset))
 
     def init_user(self, user_id: int) -> None:
-        # check if user exists and create if not
+        # create user if doesn't exist
         with self.conn:
-            res = self.conn.execute(f"SELECT * FROM {USERS_TABLE} WHERE uid={user_id}")
-            if res.fetchone() is None:
-                self.conn.execute(f"INSERT INTO {USERS_TABLE} (uid) VALUES ({user_id})")
+            self.conn.execute(f"INSERT OR IGNORE INTO {USERS_TABLE} (uid) VALUES (?)", (user_id,))
 
     def update_emot_setting(self, user_id: int, emot: int) -> None:
         # update emotion_type for user in users
         with self.conn:
-            self.conn.execute(f"UPDATE {USERS_TABLE} SET emotion_type={emot} WHERE uid={user_id}")
+            self.conn.execute(f"UPDATE {USERS_TABLE} SET emotion_type=? WHERE uid=?", (emot, user_id))
 
     def update_user_voice_setting(self, user_id: int, voice_id: int) -> None:
         # update voice_fid for user in users
         with self.conn:
-            self.conn.execute(f"UPDATE {USERS_TABLE} SET voice_fid={voice_id} WHERE uid={user_id}")
+            self.conn.execute(f"UPDATE {USERS_TABLE} SET voice_fid=? WHERE uid=?", (voice_id, user_id))
 
     def update_default_voice_setting(self, user_id: int, voice_name: str) -> None:
         # update default_voice for user in users
         with self.conn:
-            self.conn.execute(f"UPDATE {USERS_TABLE} SET default_voice='{voice_name}',voice_fid=NULL WHERE uid={user_id}")
+            self.conn.execute(f"UPDATE {USERS_TABLE} SET default_voice=?,voice_fid=NULL WHERE uid=?", (voice_name, user_id))
 
     def update_user_samples_setting(self, user_id: int, sample_num: int) -> None:
         with self.conn:
-            self.conn.execute(f"UPDATE {USERS_TABLE} SET sample_num={sample_num} WHERE uid={user_id}")
+            self.conn.execute(f"UPDATE {USERS_TABLE} SET sample_num=? WHERE uid=?", (sample_num, user_id))
+
+    def update_user_delivery_setting(self, user_id: int, delivery_mode: int) -> None:
+        with self.conn:
+            self.conn.execute(f"UPDATE {USERS_TABLE} SET delivery_mode=? WHERE uid=?", (delivery_mode, user_id))
 
     def get_user_voices(self, user_id: int) -> List[tuple]:
         # return list of (id, name) tuples for user
-        res = self.cursor.execute(f"SELECT id,name FROM {VOICES_TABLE} WHERE user_fid={user_id}")
+        res = self.cursor.execute(f"SELECT id,name FROM {VOICES_TABLE} WHERE user_fid=?", (user_id,))
         return res.fetchall()
 
     def remove_user_voice(self, user_id: int, voice_id: int) -> str:
@@ -138,40 +210,69 @@ class DBHandle(object):
         with self.conn:
             res = self.conn.execute((f"SELECT {USERS_TABLE}.voice_fid, {VOICES_TABLE}.path "
                                      f"FROM {USERS_TABLE} "
-                                     f"LEFT JOIN {VOICES_TABLE} ON {VOICES_TABLE}.id={voice_id} "
-                                     f"WHERE {USERS_TABLE}.uid={user_id}"))
+                                     f"LEFT JOIN {VOICES_TABLE} ON {VOICES_TABLE}.id=? "
+                                     f"WHERE {USERS_TABLE}.uid=?"), (voice_id, user_id))
             voice_fid, path = res.fetchone()
             if voice_fid == voice_id:
-                self.conn.execute(f"UPDATE {USERS_TABLE} SET default_voice='{DEFAULT_DEFAULT_VOICE}',voice_fid=NULL WHERE uid={user_id}")
-            self.conn.execute(f"DELETE FROM {VOICES_TABLE} WHERE id={voice_id}")
+                self.conn.execute(f"UPDATE {USERS_TABLE} SET default_voice=?,voice_fid=NULL WHERE uid=?", (DEFAULT_DEFAULT_VOICE, user_id))
+            self.conn.execute(f"DELETE FROM {VOICES_TABLE} WHERE id=?", (voice_id,))
 
         return path
 
-    def get_user_voice_setting(self, user_id: int) -> str:
-        res = self.cursor.execute(f"""SELECT {USERS_TABLE}.default_voice, {USERS_TABLE}.voice_fid,{VOICES_TABLE}.name
+    def get_user_settings(self, user_id: int) -> Tuple[str, int, int, int]:
+        # return (voice name, emotion_type, sample_num, delivery_mode) of the user in one query
+        res = self.cursor.execute(f"""SELECT {USERS_TABLE}.default_voice, {USERS_TABLE}.voice_fid, {VOICES_TABLE}.name,
+            {USERS_TABLE}.emotion_type, {USERS_TABLE}.sample_num, {USERS_TABLE}.delivery_mode
             FROM {USERS_TABLE}
             LEFT JOIN {VOICES_TABLE} ON {USERS_TABLE}.voice_fid={VOICES_TABLE}.id
-            WHERE {USERS_TABLE}.uid={user_id}""")
-        temp = res.fetchone()
-        default_voice, voice_fid, name = temp
-        if voice_fid is None:
-            return default_voice
-        else:
-            return name
-
-    def get_user_emotion_setting(self, user_id: int) -> int:
-        res = self.cursor.execute(f"SELECT emotion_type FROM {USERS_TABLE} WHERE uid={user_id}")
-        type = res.fetchone()[0]
-        return type
-
-    def get_user_samples_setting(self, user_id: int) -> int:
-        res = self.cursor.execute(f"SELECT sample_num FROM {USERS_TABLE} WHERE uid={user_id}")
-        return res.fetchone()[0]
+            WHERE {USERS_TABLE}.uid=?""", (user_id,))
+        default_voice, voice_fid, name, emotion_type, sample_num, delivery_mode = res.fetchone()
+        return default_voice if voice_fid is None else name, emotion_type, sample_num, delivery_mode
 
     def insert_user_voice(self, user_id: int, name: str, path: str) -> None:
         with self.conn:
-            self.conn.execute(f"""INSERT INTO {VOICES_TABLE} (user_fid,name,path)
-                                VALUES ({user_id},'{name}','{path}')""")
+            self.conn.execute(f"INSERT OR IGNORE INTO {VOICES_TABLE} (user_fid,name,path) VALUES (?,?,?)", (user_id, name, path))
+
+
+class AsyncDBHandle(object):
+    """
+    Async facade of DBHandle, every query runs on the dedicated db thread, so it doesn't block the event loop,
+    exposes the same methods as coroutines: await db_async.init_user(user_id)
+    """
+    def __init__(self, handle: DBHandle) -> None:
+        self.handle = handle
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+    def __getattr__(self, name: str):
+        method = getattr(self.handle, name)
+
+        async def run_query(*args):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
+        return run_query
+
+
+async def reconcile_voices(on_settings_reset: Callable[[int], None]) -> None:
+    """
+    reconcile voices table with user voices folders in background, shard by shard,
+    so that handlers queries run on the db thread in between,
+    on_settings_reset is called with id of every user whose voice was reset to the default one
+    """
+    manifest = await db_async.get_voices_manifest()
+    shards_manifest: Dict[str, Dict[int, int]] = {}
+    for uid, mtime in manifest.items():
+        shards_manifest.setdefault(get_voices_shard(uid), {})[uid] = mtime
+    reconciled = 0
+    for shard_ind in range(VOICES_SHARDS):
+        shard = get_voices_shard_name(shard_ind)
+        try:
+            shard_reconciled, users_reset = await db_async.reconcile_voices_shard(shard, shards_manifest.get(shard, {}))
+            reconciled += shard_reconciled
+            for uid in users_reset:
+                on_settings_reset(uid)
+        except Exception as e:
+            logger.error(msg=f"Failed to reconcile user voices of {shard}", exc_info=e)
+    logger.info(f"User voices reconciliation is done, {reconciled} users updated")
 
 
 db_handle = DBHandle()
+db_async = AsyncDBHandle(db_handle)
@@ -10,56 +10,48 @@ from telegram.error import TelegramError
 from telegram.ext import CallbackContext, Application, ContextTypes
 from telegram.constants import ChatAction, ParseMode
 import time
-import os
 from voice_bot.modules.bot_utils import (
     validate_text,
-    convert_to_voice,
-    clear_dir,
+    encode_voices,
     user_restricted,
     log_cmd,
     get_user_voice_dir,
     answer_query,
-    remove_temp_file,
+    download_and_decode_audio,
     logger,
     MAX_CHARS_NUM,
-    RESULTS_PATH
+    STARTED_AT,
+    admission
 )
-from voice_bot.modules.tortoise_api import tts_audio_from_text
-from voice_bot.modules.bot_db import db_handle
-from voice_bot.modules.bot_settings import get_user_settings, UserSettings, TOGGLE_GEN_INLINE_KEY
-from voice_bot.modules.bot_utils import SOURCE_WEB_LINK, QUERY_PATTERN_RETRY, get_text_locale, get_cis_locale_dict
-from voice_bot.modules.whisper_api import transcribe_voice, WHISPER_SAMPLE_RATE
+from voice_bot.modules.tts_queue import TTSJob, JobCancelledError, QueueClosedError, QueueFullError, tts_queue
+from voice_bot.modules.tts_scheduler import tts_worker_pool
+from voice_bot.modules.result_cache import get_result_key, result_cache
+from voice_bot.modules.tts_quality import QUALITY_NORMAL
+from voice_bot.modules.workspace import Workspace
+from voice_bot.modules.tts_clips import SAMPLE_RATE
+from voice_bot.modules.bot_settings import get_user_settings, settings_cache, DeliveryModes, TOGGLE_GEN_INLINE_KEY
+from voice_bot.modules.bot_utils import SOURCE_WEB_LINK, QUERY_PATTERN_RETRY, QUERY_PATTERN_CANCEL, get_text_locale, get_cis_locale_dict
+from voice_bot.modules.whisper_api import transcribe_voice_async, WHISPER_SAMPLE_RATE
 import asyncio
-from concurrent.futures import Future
-from threading import Thread
-from asyncio.events import AbstractEventLoop
-from librosa import load
-from typing import Union
+from typing import Dict, List, Optional, Set, Tuple, Union
 from numpy import ndarray
 
 
-class TTSWorkThread(Thread):
-    """
-    Thread class with active event loop to process incoming synthesis requests sequentially
-    on separate thread
-    """
-    def __init__(self):
-        Thread.__init__(self, name="tts_worker", daemon=True)  # Doesn't matter if stops unexpectedly
-        self.loop = asyncio.new_event_loop()
-
-    def run(self):
-        asyncio.set_event_loop(self.loop)
-        self.loop.run_forever()
-
-
-tts_work_thread = TTSWorkThread()
+PROGRESS_UPDATE_INTERVAL = 5  # seconds
+FIRST_UPDATE_KEY = "first_update_handled"
+# regenerate presses on the same message while its regeneration is pending are ignored, keys are (user id, message id)
+pending_regenerations: Set[Tuple[int, int]] = set()
+running_jobs: Dict[int, TTSJob] = {}  # job id: job, for cancel button
+in_flight_jobs: Dict[str, TTSJob] = {}  # result key: job synthesizing it, identical requests show its progress
+waiting_jobs: Dict[int, asyncio.Event] = {}  # job id: set when the user cancels waiting for the identical request
+VOICE_CHARS_PER_SECOND = 15  # estimate of transcribed text length to rate limit voice messages before transcription
 
 
 @user_restricted
 async def start_cmd(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /start is issued."""
     user = update.effective_user
-    db_handle.init_user(user.id)
+    await settings_cache.init_user(user.id)
     reply = get_text_locale(user, get_cis_locale_dict(f"Здравствуйте, {user.mention_html()}! Вызовите /help чтобы узнать как пользоваться ботом"),
                             f"Hi, {user.mention_html()}! Call /help to get info about bot usage")
     await update.message.reply_html(reply)
@@ -70,7 +62,7 @@ async def gen_audio_cmd(update: Update, context: CallbackContext) -> None:
     """Send voice audio file generated by inference"""
     reply_id = update.message.message_id
     user = update.effective_user
-    db_handle.init_user(user.id)
+    await settings_cache.init_user(user.id)
     if not context.args:
         reply = get_text_locale(user, get_cis_locale_dict("Ошибка: неверно вызвана команда, предоставьте текст вместе с командой (прим. /gen текст)"),
                                 "Error: invalid arguments provided, provide text next to the command")
@@ -84,8 +76,7 @@ async def gen_audio_cmd(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text(reply, reply_to_message_id=reply_id)
         return
 
-    prog_msg: Message = await create_progress_msg(update, context)
-    context.application.create_task(start_gen_task(update, context, text, prog_msg), update=update)
+    context.application.create_task(start_gen_task(update, context, text), update=update)
 
 
 @user_restricted
@@ -94,7 +85,7 @@ async def gen_audio_inline(update: Update, context: CallbackContext) -> None:
     inline_toggle = context.user_data.get(TOGGLE_GEN_INLINE_KEY, None)
     reply_id = update.message.message_id
     user = update.effective_user
-    db_handle.init_user(user.id)
+    await settings_cache.init_user(user.id)
     if not inline_toggle:
         reply = get_text_locale(user, get_cis_locale_dict("Подсказка: если вы пытаетесь вызвать синтез, пожалуйста включите данный режим командой /toggle_inline"),
                                 "Hint: if you trying to start audio synthesis, please enable the inline mode via /toggle_inline")
@@ -108,8 +99,7 @@ async def gen_audio_inline(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text(reply, reply_to_message_id=reply_id)
         return
 
-    prog_msg: Message = await create_progress_msg(update, context)
-    context.application.create_task(start_gen_task(update, context, text, prog_msg), update=update)
+    context.application.create_task(start_gen_task(update, context, text), update=update)
 
 
 @user_restricted
@@ -132,12 +122,39 @@ async def retry_button(update: Update, context: CallbackContext) -> None:
     """launches tts task on a already completed one from the message keyboard"""
     query = update.callback_query
     user = update.effective_user
-    db_handle.init_user(user.id)
+    await settings_cache.init_user(user.id)
+    regen_key = (user.id, query.message.message_id)
+    if regen_key in pending_regenerations:  # coalesce repeated presses into the pending job
+        reply = get_text_locale(user, get_cis_locale_dict("Уже генерируется, пожалуйста подождите"), "Already regenerating, please wait")
+        context.application.create_task(query.answer(text=reply), update=update)
+        return
     context.application.create_task(answer_query(query), update=update)
 
-    prog_msg: Message = await create_progress_msg(update, context)
     # TODO get actual message text instead of caption
-    context.application.create_task(start_gen_task(update, context, query.message.caption, prog_msg), update=update)
+    pending_regenerations.add(regen_key)
+    context.application.create_task(regenerate_task(update, context, regen_key), update=update)
+
+
+async def regenerate_task(update: Update, context: CallbackContext, regen_key: Tuple[int, int]) -> None:
+    try:
+        await start_gen_task(update, context, update.callback_query.message.caption, use_cache=False)
+    finally:
+        pending_regenerations.discard(regen_key)
+
+
+@user_restricted
+async def cancel_button(update: Update, context: CallbackContext) -> None:
+    """cancel synthesis job from the progress message keyboard"""
+    query = update.callback_query
+    user = update.effective_user
+    job = running_jobs.get(int(query.data[len(QUERY_PATTERN_CANCEL):]), None)
+    if job is None or job.user_id != user.id or not tts_queue.cancel(job):
+        reply = get_text_locale(user, get_cis_locale_dict("Синтез уже завершен"), "Synthesis is already finished")
+    else:
+        if job.job_id in waiting_jobs:  # job isn't queued, it waits for the identical request
+            waiting_jobs[job.job_id].set()
+        reply = get_text_locale(user, get_cis_locale_dict("Синтез отменяется"), "Synthesis is being cancelled")
+    await query.answer(text=reply)
 
 
 async def help_cmd(update: Update, context: CallbackContext) -> None:
@@ -167,27 +184,45 @@ async def help_cmd(update: Update, context: CallbackContext) -> None:
 async def gen_audio_from_voice(update: Update, context: CallbackContext) -> None:
     """reply to voice msg"""
     user = update.effective_user
-    db_handle.init_user(user.id)
+    await settings_cache.init_user(user.id)
 
     if update.message.voice:  # validate voice file
-        filetype = "ogg"
-        file_path = os.path.abspath(os.path.join(RESULTS_PATH, f'{user.id}_{int(time.time())}.{filetype}'))
+        if not await admit_request(update, update.message.voice.duration * VOICE_CHARS_PER_SECOND):
+            return
         try:
-            with open(file_path, mode='w'):
-                pass
-            file = await context.bot.get_file(update.message.voice)
-            await file.download_to_drive(file_path)
-            audio, _ = load(file_path, sr=WHISPER_SAMPLE_RATE)
+            audio, _, _ = await download_and_decode_audio(context.bot, update.message.voice, WHISPER_SAMPLE_RATE)
         except Exception as e:
-            remove_temp_file(file_path)
             raise TelegramError("Audio from voice Error: download failure") from e
-        finally:
-            remove_temp_file(file_path)
     else:
         raise TelegramError("Audio from voice Error: no voice")
 
-    prog_msg: Message = await create_progress_msg(update, context)
-    context.application.create_task(start_gen_task(update, context, audio, prog_msg), update=update)
+    context.application.create_task(start_gen_task(update, context, audio), update=update)
+
+
+async def admit_request(update: Update, text_len: int, settings=None) -> bool:
+    """
+    rate limit synthesis requests, replies to rejected ones, returns True if admitted,
+    with settings given it doesn't yield to the event loop before the decision
+    """
+    user = update.effective_user
+    if settings is None:
+        settings = await get_user_settings(user.id)
+    wait_time = admission.try_admit(user.id, admission.get_cost(text_len, settings.samples_num))
+    if not wait_time:
+        return True
+    logger.info(f"Synthesis request of user: {user.full_name} with id: {user.id} is rate limited")
+    reply = get_text_locale(user, get_cis_locale_dict(f"Слишком много запросов, пожалуйста повторите через {int(wait_time) + 1} сек."),
+                            f"Too many requests, please try again in {int(wait_time) + 1}s")
+    await update.effective_message.reply_text(reply, reply_to_message_id=update.effective_message.message_id)
+    return False
+
+
+async def log_first_update(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """report time from the start to the first handled update once"""
+    if context.bot_data.get(FIRST_UPDATE_KEY, False):
+        return
+    context.bot_data[FIRST_UPDATE_KEY] = True
+    logger.info(f"First update is handled in {time.monotonic() - STARTED_AT:.1f}s since start")
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -204,87 +239,318 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 """ ------------------------------TTS related callbacks------------------------------ """
 
 
-async def start_gen_task(update: Update, context: CallbackContext, data: Union[str, ndarray], progress_msg: Message) -> None:
-    """data - represents text, in case of text message handle and audio data, in case of voice mesage handle"""
+async def start_gen_task(update: Update, context: CallbackContext, data: Union[str, ndarray], use_cache: bool = True) -> None:
+    """
+    data - represents text, in case of text message handle and audio data, in case of voice mesage handle
+    use_cache - reply with a cached result of the identical request if there is one, regeneration doesn't use it
+    rate limit is charged only when the request is synthesized, replies from the cache are free,
+    voice messages are charged by their duration before transcription
+    """
     user = update.effective_user
-    filename_result = os.path.abspath(os.path.join(RESULTS_PATH, '{}_{}.wav'.format(user.id, int(time.time()))))
-    settings = get_user_settings(user.id)
-    loop = asyncio.get_running_loop()
-    future = asyncio.run_coroutine_threadsafe(run_gen_audio(update, context.application, progress_msg, filename_result, settings, data, get_user_voice_dir(user.id), loop), tts_work_thread.loop)
-    future.add_done_callback(eval_gen_task)
-
-
-async def run_gen_audio(update: Update, app: Application, progerss_msg: Message, filename_result: str, settings: UserSettings, data: Union[str, ndarray], user_voices_dir: str, app_loop: AbstractEventLoop) -> None:
-    """Running on tts_worker thread"""
-    try:
-        if isinstance(data, ndarray):  # transcibe voice data
-            data = transcribe_voice(data)
-            val_res, val_err_msg = validate_text(update.effective_user, data)
+    charged = isinstance(data, ndarray)
+    if isinstance(data, ndarray):  # transcibe voice data before queueing synthesis
+        try:
+            data = await transcribe_voice_async(data)
+            val_res, val_err_msg = validate_text(user, data)
             if not val_res:
                 raise Exception(f"text validation error: {val_err_msg}")
+        except Exception as e:
+            await post_eval_gen_report_error(update, None, e)
+            return
 
-        tts_audio_from_text(filename_result, data, settings.voice, user_voices_dir, settings.emotion, settings.samples_num)
-    except Exception as e:
-        async def handle_post_eval_gen_report_error(update: Update, app: Application, progress_msg: Message, exc: Exception) -> None:
-            app.create_task(post_eval_gen_report_error(update, progress_msg, exc), update=update)
+    settings = await get_user_settings(user.id)
+    workspace = Workspace(str(user.id))
+    try:
+        job = TTSJob(user, workspace, data, settings, get_user_voice_dir(user.id), use_cache)
+        result_key = None
+        if use_cache and result_cache.is_enabled():  # voice fingerprint reads the samples folder
+            result_key = await asyncio.get_running_loop().run_in_executor(
+                None, get_result_key, job.text, job.voice, job.user_voices_dir, job.emotion, job.candidates, job.preset)
+        if result_key is None:
+            if charged or await admit_request(update, len(data), settings):
+                await run_gen_job(update, context, job, settings)
+            return
+
+        # identical requests share one synthesis, the rest are replied from the cache
+        while True:
+            if await send_cached_result(update, data, result_key):
+                return
+            if result_key not in result_cache.in_flight:
+                break
+            if not await wait_identical_request(update, context, job, result_key):
+                return
+        if not charged and not await admit_request(update, len(data), settings):  # doesn't yield, no identical request starts meanwhile
+            return
+        in_flight = result_cache.in_flight[result_key] = asyncio.get_running_loop().create_future()
+        in_flight_jobs[result_key] = job
+        try:
+            await run_gen_job(update, context, job, settings, result_key)
+        finally:
+            del result_cache.in_flight[result_key]
+            del in_flight_jobs[result_key]
+            in_flight.set_result(None)
+    finally:
+        workspace.release()
 
-        asyncio.run_coroutine_threadsafe(handle_post_eval_gen_report_error(update, app, progerss_msg, e), app_loop)
 
-    return update, app, progerss_msg, filename_result, data, settings.samples_num
+async def wait_identical_request(update: Update, context: CallbackContext, job: TTSJob, result_key: str) -> bool:
+    """
+    wait for synthesis of the identical request, the user gets a progress message of it with own cancel button,
+    returns False if the user has cancelled waiting
+    """
+    app = context.application
+    in_flight = result_cache.in_flight[result_key]
+    cancelled = waiting_jobs[job.job_id] = asyncio.Event()
+    running_jobs[job.job_id] = job
+    progress_msg, tracker, cancel_wait = None, None, None
+    try:
+        progress_msg = await create_progress_msg(update, context, job, in_flight_jobs[result_key])
+        tracker = app.create_task(track_progress_msg(update, job, progress_msg, in_flight_jobs[result_key]), update=update)
+        cancel_wait = asyncio.ensure_future(cancelled.wait())
+        await asyncio.wait([in_flight, cancel_wait], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        running_jobs.pop(job.job_id, None)
+        waiting_jobs.pop(job.job_id, None)
+        for task in (tracker, cancel_wait):
+            if task is not None:
+                task.cancel()
+        if progress_msg is not None:
+            app.create_task(delete_progress_msg(progress_msg), update=update)
+    if cancelled.is_set():
+        logger.info(f"User: {update.effective_user.full_name} has cancelled waiting for the identical request")
+        return False
+    return True
+
+
+async def run_gen_job(update: Update, context: CallbackContext, job: TTSJob, settings, result_key: Optional[str] = None) -> None:
+    """queue synthesis job, reply with the results, result_key - store the results into the cache with it"""
+    app = context.application
+    try:
+        tts_queue.put(job)
+    except QueueFullError as e:
+        await reply_queue_full(update, e)
+        return
+    except QueueClosedError as e:
+        await reply_tts_unavailable(update, e)
+        return
 
+    parts_sender = None
+    if settings.delivery_mode != DeliveryModes.Single and len(job.clips) > 1:
+        parts_sender = start_parts_delivery(update, app, job)
 
-def eval_gen_task(future: Future) -> None:
+    running_jobs[job.job_id] = job
+    try:
+        progress_msg: Message = await create_progress_msg(update, context, job)
+    except Exception:
+        running_jobs.pop(job.job_id, None)
+        tts_queue.cancel(job)  # request has failed, free its place in the queue
+        if parts_sender:
+            await parts_sender.stop()
+        raise
+    app.create_task(track_progress_msg(update, job, progress_msg), update=update)
     try:
-        update, app, progress_msg, filename_result, text, samples_num = future.result()
+        await asyncio.wrap_future(job.future)
+    except JobCancelledError:
+        logger.info(f"Synthesis job of user: {update.effective_user.full_name} is cancelled")
+        app.create_task(delete_progress_msg(progress_msg), update=update)
+        return
+    except QueueClosedError as e:
+        app.create_task(delete_progress_msg(progress_msg), update=update)
+        await reply_tts_unavailable(update, e)
+        return
     except Exception as e:
-        logger.error(msg="Exception while handling eval_gen_task:", exc_info=e)
+        await post_eval_gen_report_error(update, progress_msg, e)
+        return
+    finally:
+        running_jobs.pop(job.job_id, None)
+        if parts_sender:
+            await parts_sender.stop()
+
+    if parts_sender:
+        if settings.delivery_mode == DeliveryModes.Progressive:  # complete audio isn't sent, so it isn't cached either
+            app.create_task(delete_progress_msg(progress_msg), update=update)
+            return
+    if job.quality != QUALITY_NORMAL.name:  # cache key is made for requested parameters, load changed them
+        result_key = None
+    await post_eval_gen_task(update, app, job.text, job.result_audio, update.effective_message, progress_msg, job.workspace.path, result_key)
+
+
+async def send_cached_result(update: Update, text: str, result_key: str) -> bool:
+    """reply with the cached result, returns False on cache miss"""
+    loop = asyncio.get_running_loop()
+    voices = await loop.run_in_executor(None, result_cache.get, result_key)
+    if voices is None:
+        return False
+    logger.info(f"Reply from result cache for user: {update.effective_user.full_name}")
+    try:
+        file_ids = await send_voices(update.effective_user, text, voices, update.effective_message)
+    except Exception as e:
+        raise TelegramError("Audio generation Error") from e
+    await loop.run_in_executor(None, result_cache.set_file_ids, result_key, file_ids)
+    return True
+
+
+async def reply_queue_full(update: Update, exc: QueueFullError) -> None:
+    user = update.effective_user
+    logger.info(f"Synthesis request of user: {user.full_name} with id: {user.id} rejected: {exc}")
+    if exc.user_limit:
+        reply = get_text_locale(user, get_cis_locale_dict("Слишком много ваших запросов в очереди, пожалуйста дождитесь их завершения"),
+                                "You have too many requests in the queue, please wait for them to finish")
     else:
-        app.create_task(post_eval_gen_task(update, app, filename_result, text, samples_num, update.effective_message, progress_msg), update=update)
+        reply = get_text_locale(user, get_cis_locale_dict("Очередь синтеза переполнена, пожалуйста попробуйте позже"),
+                                "Synthesis queue is full, please try again later")
+    await update.effective_message.reply_text(reply, reply_to_message_id=update.effective_message.message_id)
 
 
-async def post_eval_gen_report_error(update: Update, progress_msg: Message, exc) -> None:
-    """handles errors from tts_worker thread in a main thread"""
-    clear_dir(RESULTS_PATH)
-    logger.error(msg="Exception while handling run_gen_audio:", exc_info=exc)
-    await delete_progress_msg(progress_msg)
+async def reply_tts_unavailable(update: Update, exc: QueueClosedError) -> None:
+    user = update.effective_user
+    logger.error(f"Synthesis request of user: {user.full_name} with id: {user.id} rejected: {exc}")
+    reply = get_text_locale(user, get_cis_locale_dict("Синтез речи сейчас недоступен, пожалуйста попробуйте позже"),
+                            "Speech synthesis is unavailable now, please try again later")
+    await update.effective_message.reply_text(reply, reply_to_message_id=update.effective_message.message_id)
+
+
+async def post_eval_gen_report_error(update: Update, progress_msg: Optional[Message], exc) -> None:
+    """handles errors from tts worker or transcription in a main thread"""
+    logger.error(msg="Exception while handling synthesis job:", exc_info=exc)
+    if progress_msg:
+        await delete_progress_msg(progress_msg)
     if update and update.effective_message and update.effective_user:
         reply = get_text_locale(update.effective_user, get_cis_locale_dict(f"{update.effective_user.mention_html()}, к сожалению синтез аудио завершился ошибкой, пожалуйста попробуйте еще раз"),
                                 f"Sorry {update.effective_user.mention_html()}, your audio generation failed, please try again")
         await update.effective_message.reply_html(reply, reply_to_message_id=update.effective_message.message_id)
 
 
-async def post_eval_gen_task(update: Update, app: Application, filename_result: str, text: str, samples_num: int, message: Message, progress_msg: Message) -> None:
+async def post_eval_gen_task(update: Update, app: Application, text: str, results: List[ndarray], message: Message, progress_msg: Message,
+                             scratch_dir: str, result_key: Optional[str] = None) -> None:
 
     try:
-        user: User = update.effective_user
-        for sample_ind in range(samples_num):
-            sample_file = filename_result.replace(".wav", f"_{sample_ind}.wav")
-            voice_file = convert_to_voice(sample_file)
-            with open(voice_file, 'rb') as audio:
-                keyboard = [[InlineKeyboardButton(get_text_locale(user, get_cis_locale_dict("Генерировать снова"), "Regenerate"), callback_data=QUERY_PATTERN_RETRY)]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                if len(text) > MAX_CHARS_NUM:  # elide to prevent hitting max caption size
-                    text = f"{text[:MAX_CHARS_NUM]}..."
-                await message.reply_voice(voice=audio, caption=text, reply_to_message_id=message.message_id, reply_markup=reply_markup)
-
-            logger.info(f"Audio generation DONE: called by {user.full_name}, for sample №{sample_ind}, with query: {text}")
+        loop = asyncio.get_running_loop()
+        voices = [voice.getvalue() for voice in await encode_voices(results, SAMPLE_RATE, scratch_dir)]
+        if result_key:
+            await loop.run_in_executor(None, result_cache.put, result_key, voices)
+        file_ids = await send_voices(update.effective_user, text, voices, message)
+        if result_key:
+            await loop.run_in_executor(None, result_cache.set_file_ids, result_key, file_ids)
     except Exception as e:
-        app.create_task(delete_progress_msg(progress_msg), update=update)
-        clear_dir(RESULTS_PATH)
         raise TelegramError("Audio generation Error") from e
-    else:
+    finally:
         app.create_task(delete_progress_msg(progress_msg), update=update)
-        clear_dir(RESULTS_PATH)
 
 
-async def create_progress_msg(update: Update, context: CallbackContext):
-    """send chat action and a progress message and return the Message"""
+async def send_voices(user: User, text: str, voices: List[Union[str, bytes]], message: Message) -> List[Optional[str]]:
+    """
+    reply to the message with encoded voices or telegram file ids of already uploaded ones, text is used as a caption
+    voices are uploaded concurrently (media group can't contain voice messages with keyboards)
+    returns file ids of the sent voices
+    """
+    keyboard = [[InlineKeyboardButton(get_text_locale(user, get_cis_locale_dict("Генерировать снова"), "Regenerate"), callback_data=QUERY_PATTERN_RETRY)]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    if len(text) > MAX_CHARS_NUM:  # elide to prevent hitting max caption size
+        text = f"{text[:MAX_CHARS_NUM]}..."
+
+    async def send_voice(sample_ind: int, voice: Union[str, bytes]) -> Optional[str]:
+        reply = await message.reply_voice(voice=voice, caption=text, reply_to_message_id=message.message_id, reply_markup=reply_markup)
+        logger.info(f"Audio generation DONE: called by {user.full_name}, for sample №{sample_ind}, with query: {text}")
+        return reply.voice.file_id if reply.voice else None
+
+    return list(await asyncio.gather(*[send_voice(sample_ind, voice) for sample_ind, voice in enumerate(voices)]))
+
+
+class PartsSender(object):
+    """
+    Sends parts of the job audio as soon as the tts worker reports them ready,
+    parts are passed from worker thread through asyncio queue and sent in order
+    """
+    def __init__(self, update: Update, app: Application, job: TTSJob) -> None:
+        self.update = update
+        self.job = job
+        self.workspace = job.workspace.acquire()
+        self.loop = asyncio.get_running_loop()
+        self.parts: asyncio.Queue = asyncio.Queue()
+        self.task = app.create_task(self.run(), update=update)
+
+    def on_clips_ready(self, start: int, end: int, pcm: List[ndarray]) -> None:
+        """called on tts worker thread"""
+        self.loop.call_soon_threadsafe(self.parts.put_nowait, (start, end, pcm))
+
+    async def run(self) -> None:
+        try:
+            await self.send_parts()
+        finally:
+            self.workspace.release()
+
+    async def send_parts(self) -> None:
+        while True:
+            part = await self.parts.get()
+            if part is None:
+                return
+            start, end, pcm = part
+            text = " ".join(self.job.get_clip_text(clip_ind) for clip_ind in range(start, end))
+            try:
+                voices = [voice.getvalue() for voice in await encode_voices(pcm, SAMPLE_RATE, self.workspace.path)]
+                await send_voices(self.update.effective_user, text, voices, self.update.effective_message)
+            except Exception as e:
+                logger.error(msg="Exception while sending synthesized part:", exc_info=e)
+
+    async def stop(self) -> None:
+        """wait for the already reported parts to be sent"""
+        self.parts.put_nowait(None)
+        await self.task
+
+
+def start_parts_delivery(update: Update, app: Application, job: TTSJob) -> PartsSender:
+    sender = PartsSender(update, app, job)
+    job.clip_callback = sender.on_clips_ready
+    return sender
+
+
+def get_progress_text(user: User, job: TTSJob) -> str:
+    wait_emoji_ucode: str = "\U000023F3"
+    place, eta = tts_queue.get_position(job)
+    if place == 0:
+        return get_text_locale(user, get_cis_locale_dict(f"{wait_emoji_ucode}Синтез в процессе...{wait_emoji_ucode}"),
+                               f"{wait_emoji_ucode}Synthesis is in progress...{wait_emoji_ucode}")
+    if not tts_worker_pool.is_ready():  # eta is unknown until the model is loaded
+        return get_text_locale(user, get_cis_locale_dict(f"{wait_emoji_ucode}Модель загружается, место в очереди: {place}{wait_emoji_ucode}"),
+                               f"{wait_emoji_ucode}Model is loading, place in queue: {place}{wait_emoji_ucode}")
+    return get_text_locale(user, get_cis_locale_dict(f"{wait_emoji_ucode}Место в очереди: {place}, примерное ожидание: {int(eta)} сек.{wait_emoji_ucode}"),
+                           f"{wait_emoji_ucode}Place in queue: {place}, estimated wait: {int(eta)}s{wait_emoji_ucode}")
+
+
+async def create_progress_msg(update: Update, context: CallbackContext, job: TTSJob, progress_job: Optional[TTSJob] = None):
+    """
+    send chat action and a progress message with job queue position and return the Message,
+    progress_job - job whose position is shown instead, e.g. synthesizing the identical request
+    """
     bot: Bot = context.bot
     chat_id: int = update.effective_chat.id
-    wait_emoji_ucode: str = "\U000023F3"
     await bot.send_chat_action(chat_id=chat_id, action=ChatAction.RECORD_VOICE)
-    return await bot.send_message(chat_id=chat_id, text=get_text_locale(update.effective_user, get_cis_locale_dict(f"{wait_emoji_ucode}Синтез в процессе...{wait_emoji_ucode}"),
-                                  f"{wait_emoji_ucode}Synthesis is in progress...{wait_emoji_ucode}"))
+    return await bot.send_message(chat_id=chat_id, text=get_progress_text(update.effective_user, progress_job or job),
+                                  reply_markup=get_progress_markup(update.effective_user, job))
+
+
+def get_progress_markup(user: User, job: TTSJob) -> InlineKeyboardMarkup:
+    keyboard = [[InlineKeyboardButton(get_text_locale(user, get_cis_locale_dict("Отменить"), "Cancel"), callback_data=f"{QUERY_PATTERN_CANCEL}{job.job_id}")]]
+    return InlineKeyboardMarkup(keyboard)
+
+
+async def track_progress_msg(update: Update, job: TTSJob, msg: Message, progress_job: Optional[TTSJob] = None) -> None:
+    """update queue position of progress_job (job by default) in the progress message until it's done"""
+    progress_job = progress_job or job
+    text = msg.text
+    reply_markup = get_progress_markup(update.effective_user, job)
+    while not progress_job.future.done():
+        await asyncio.sleep(PROGRESS_UPDATE_INTERVAL)
+        if progress_job.future.done():
+            break
+        new_text = get_progress_text(update.effective_user, progress_job)
+        if new_text != text:
+            try:
+                await msg.edit_text(new_text, reply_markup=reply_markup)
+                text = new_text
+            except TelegramError:  # message is deleted or not modified
+                pass
 
 
 async def delete_progress_msg(msg: Message) -> None:
@@ -1,9 +1,12 @@
+import time
 from enum import Enum
-from voice_bot.modules.bot_db import db_handle
+from typing import Dict
+from voice_bot.modules.bot_db import db_async
 
 
 MAX_USER_VOICES_COUNT = 20
 TOGGLE_GEN_INLINE_KEY = "toggle_gen_inline"
+SETTINGS_CACHE_TTL = 3600  # seconds, settings of users idle for longer are dropped
 
 
 class Emotions(Enum):
@@ -31,21 +34,107 @@ EMOTION_VALUES = {
 }
 
 
+class DeliveryModes(Enum):
+    Single = 0  # send complete audio when synthesis is done
+    Progressive = 1  # send audio by parts as soon as they are ready
+    ProgressiveFinal = 2  # send by parts, then complete audio
+
+
+DELIVERY_VALUES = {
+    DeliveryModes.Single.value: DeliveryModes.Single,
+    DeliveryModes.Progressive.value: DeliveryModes.Progressive,
+    DeliveryModes.ProgressiveFinal.value: DeliveryModes.ProgressiveFinal
+}
+
+
 class UserSettings(object):
-    def __init__(self, voice: str, emot: str, samples: int) -> None:
+    __slots__ = ("voice", "emotion", "samples_num", "delivery_mode", "last_used")
+
+    def __init__(self, voice: str, emot: str, samples: int, delivery: DeliveryModes) -> None:
         self.voice = voice
-        self.emotion = emot
+        self.emotion = emot  # None for Neutral, so that emotion string isn't prepended
         self.samples_num = samples
+        self.delivery_mode = delivery
+        self.last_used = time.monotonic()
+
+
+class UserSettingsCache(object):
+    """
+    Settings of active users, loaded in one query and updated write-through,
+    so that synthesis requests don't query the db, settings of idle users expire
+    used from the event loop only
+    """
+    def __init__(self) -> None:
+        self.entries: Dict[int, UserSettings] = {}
+        self.last_sweep = time.monotonic()
+
+    async def init_user(self, user_id: int) -> None:
+        """create user in db on the first request, no queries for cached users"""
+        if user_id in self.entries:
+            return
+        await db_async.init_user(user_id)
+        await self.load(user_id)
+
+    async def get(self, user_id: int) -> UserSettings:
+        self.expire()
+        settings = self.entries.get(user_id, None)
+        if settings is None:
+            return await self.load(user_id)
+        settings.last_used = time.monotonic()
+        return settings
+
+    async def load(self, user_id: int) -> UserSettings:
+        voice, emot_type, samples_num, delivery_type = await db_async.get_user_settings(user_id)
+        emot = EMOTION_VALUES[emot_type]
+        settings = self.entries[user_id] = UserSettings(voice, None if emot == Emotions.Neutral else emot.name, samples_num, DELIVERY_VALUES[delivery_type])
+        return settings
+
+    def invalidate(self, user_id: int) -> None:
+        self.entries.pop(user_id, None)
+
+    async def update_emotion(self, user_id: int, emot: Emotions) -> None:
+        await db_async.update_emot_setting(user_id, emot.value)
+        settings = self.entries.get(user_id, None)
+        if settings:
+            settings.emotion = None if emot == Emotions.Neutral else emot.name
+
+    async def update_default_voice(self, user_id: int, voice_name: str) -> None:
+        await db_async.update_default_voice_setting(user_id, voice_name)
+        settings = self.entries.get(user_id, None)
+        if settings:
+            settings.voice = voice_name
+
+    async def update_user_voice(self, user_id: int, voice_id: int) -> None:
+        await db_async.update_user_voice_setting(user_id, voice_id)
+        await self.load(user_id)  # voice name is stored in voices table
+
+    async def update_samples(self, user_id: int, samples_num: int) -> None:
+        await db_async.update_user_samples_setting(user_id, samples_num)
+        settings = self.entries.get(user_id, None)
+        if settings:
+            settings.samples_num = samples_num
+
+    async def update_delivery(self, user_id: int, delivery: DeliveryModes) -> None:
+        await db_async.update_user_delivery_setting(user_id, delivery.value)
+        settings = self.entries.get(user_id, None)
+        if settings:
+            settings.delivery_mode = delivery
+
+    def expire(self) -> None:
+        now = time.monotonic()
+        if now - self.last_sweep < SETTINGS_CACHE_TTL:
+            return
+        self.last_sweep = now
+        for user_id in [user_id for user_id, settings in self.entries.items() if now - settings.last_used > SETTINGS_CACHE_TTL]:
+            del self.entries[user_id]
+
+
+settings_cache = UserSettingsCache()
 
 
-def get_emotion_name(user_id: int) -> str:
-    return EMOTION_VALUES[db_handle.get_user_emotion_setting(user_id)].name
+async def get_emotion_name(user_id: int) -> str:
+    return (await settings_cache.get(user_id)).emotion or Emotions.Neutral.name
 
 
-def get_user_settings(user_id: int) -> UserSettings:
-    voice = db_handle.get_user_voice_setting(user_id)
-    emot = get_emotion_name(user_id)
-    samples_num = db_handle.get_user_samples_setting(user_id)
-    if emot == Emotions.Neutral.name:  # if Neutral then don't prepend emotion string
-        emot = None
-    return UserSettings(voice, emot, samples_num)
+async def get_user_settings(user_id: int) -> UserSettings:
+    return await settings_cache.get(user_id)
@@ -12,25 +12,31 @@ from voice_bot.modules.bot_utils import (
     get_cis_locale_dict,
     config,
     logger,
-    QUERY_PATTERN_RETRY
+    get_user_voice_dir,
+    QUERY_PATTERN_RETRY,
+    QUERY_PATTERN_CANCEL
 )
-from voice_bot.modules.bot_handlers import retry_button
-from voice_bot.modules.bot_settings import EMOTION_STRINGS, get_emotion_name
+from voice_bot.modules.bot_handlers import retry_button, cancel_button
+from voice_bot.modules.bot_settings import EMOTION_STRINGS, DeliveryModes, get_emotion_name, get_user_settings, settings_cache
 from enum import Enum
-from voice_bot.modules.bot_db import db_handle
+from voice_bot.modules.bot_db import db_async
+from voice_bot.modules.voice_cache import remove_latents_file
 import json
 from itertools import zip_longest
 import shutil
+import os
 
 
 SETTINGS_MENU_TEXT = "Edit Settings:"
 VOICES_MENU_TEXT = "Edit Settings:\nSelect Voice:"
 EMOT_MENU_TEXT = "Edit Settings:\nSelect Emotion:"
 SAMPLES_MENU_TEXT = "Edit Settings:\nSelect Number of Samples:"
+DELIVERY_MENU_TEXT = "Edit Settings:\nSelect Delivery Mode:"
 SETTINGS_MENU_TEXT_RU = "Настройки:"
 VOICES_MENU_TEXT_RU = "Настройки:\nУкажите голос:"
 EMOT_MENU_TEXT_RU = "Настройки:\nУкажите эмоцию:"
 SAMPLES_MENU_TEXT_RU = "Настройки:\nУкажите число генерируемых аудио:"
+DELIVERY_MENU_TEXT_RU = "Настройки:\nУкажите способ отправки аудио:"
 MENU_LOAD_ERR = "Failed to fetch settings"
 MENU_LOAD_ERR_RU = "Не удалось загрузить настройки"
 MENU_SET_ERR = "Failed to set settings"
@@ -47,6 +53,7 @@ class SettingsMenuStates(Enum):
     close_menu = 4
     back = 5
     remove_voice = 6
+    select_delivery = 7
 
 
 """-----------------------------------Menu constructors-----------------------------------"""
@@ -57,6 +64,7 @@ def build_settings_menu(user: User) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(get_text_locale(user, get_cis_locale_dict("Выбрать голос"), "Select Voice"), callback_data=QUERY_PATTERN_SETTINGS + SettingsMenuStates.select_voice.name)],
         [InlineKeyboardButton(get_text_locale(user, get_cis_locale_dict("Выбрать эмоцию"), "Select Emotion"), callback_data=QUERY_PATTERN_SETTINGS + SettingsMenuStates.select_emotion.name)],
         [InlineKeyboardButton(get_text_locale(user, get_cis_locale_dict("Выбрать число генерируемых аудио"), "Select Number Of Samples"), callback_data=QUERY_PATTERN_SETTINGS + SettingsMenuStates.select_samples.name)],
+        [InlineKeyboardButton(get_text_locale(user, get_cis_locale_dict("Выбрать способ отправки аудио"), "Select Delivery Mode"), callback_data=QUERY_PATTERN_SETTINGS + SettingsMenuStates.select_delivery.name)],
         [InlineKeyboardButton(get_text_locale(user, get_cis_locale_dict("Удалить голос"), "Remove Voice"), callback_data=QUERY_PATTERN_SETTINGS + SettingsMenuStates.remove_voice.name)],
         [InlineKeyboardButton(get_text_locale(user, get_cis_locale_dict("Закрыть"), "Close"), callback_data=QUERY_PATTERN_SETTINGS + SettingsMenuStates.close_menu.name)]
     ]
@@ -75,7 +83,22 @@ def build_samples_menu(user: User) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(buttons)
 
 
-def build_voices_list(user: User, show_default: bool) -> InlineKeyboardMarkup:
+def get_delivery_mode_name(user: User, mode: DeliveryModes) -> str:
+    names = {
+        DeliveryModes.Single: get_text_locale(user, get_cis_locale_dict("Целиком"), "Single file"),
+        DeliveryModes.Progressive: get_text_locale(user, get_cis_locale_dict("По частям"), "By parts"),
+        DeliveryModes.ProgressiveFinal: get_text_locale(user, get_cis_locale_dict("По частям и целиком"), "By parts, then single file")
+    }
+    return names[mode]
+
+
+def build_delivery_menu(user: User) -> InlineKeyboardMarkup:
+    buttons = [[InlineKeyboardButton(get_delivery_mode_name(user, mode), callback_data=QUERY_PATTERN_SETTINGS + mode.name)] for mode in DeliveryModes]
+    buttons.append([InlineKeyboardButton(get_text_locale(user, get_cis_locale_dict("Назад"), "Back"), callback_data=QUERY_PATTERN_SETTINGS + SettingsMenuStates.back.name)])
+    return InlineKeyboardMarkup(buttons)
+
+
+async def build_voices_list(user: User, show_default: bool) -> InlineKeyboardMarkup:
     """
     voice btn callback is following json format:
     {
@@ -86,7 +109,7 @@ def build_voices_list(user: User, show_default: bool) -> InlineKeyboardMarkup:
     """
     default_voices = config.default_voices if show_default else []
     buttons_default_col = [InlineKeyboardButton(name, callback_data=QUERY_PATTERN_SETTINGS + json.dumps({"is_default": True, "data": name})) for name in default_voices]
-    user_voices = db_handle.get_user_voices(user.id)  # tuples of (id, name)
+    user_voices = await db_async.get_user_voices(user.id)  # tuples of (id, name)
     if user_voices:
         buttons_user_col = [InlineKeyboardButton(name, callback_data=QUERY_PATTERN_SETTINGS + json.dumps({"is_default": False, "data": id})) for id, name in user_voices]
     else:
@@ -135,7 +158,7 @@ async def choose_setting(update: Update, context: CallbackContext) -> int:
     data = await get_query_data(query)
     if data == SettingsMenuStates.select_emotion.name:
         try:
-            active_emot = get_emotion_name(update.effective_user.id)
+            active_emot = await get_emotion_name(update.effective_user.id)
             reply = get_text_locale(update.effective_user, get_cis_locale_dict(f"{EMOT_MENU_TEXT_RU}\nТекущая: {active_emot}"), f"{EMOT_MENU_TEXT}\nCurrent: {active_emot}")
             await query.edit_message_text(reply, reply_markup=build_emotion_menu(update.effective_user))
         except Exception as e:
@@ -149,9 +172,9 @@ async def choose_setting(update: Update, context: CallbackContext) -> int:
 
     if data == SettingsMenuStates.select_voice.name:
         try:
-            active_voice = db_handle.get_user_voice_setting(update.effective_user.id)
+            active_voice = (await get_user_settings(update.effective_user.id)).voice
             reply = get_text_locale(update.effective_user, get_cis_locale_dict(f"{VOICES_MENU_TEXT_RU}\nТекущий: {active_voice}\nСтандартные голоса:\tПользов. голоса:"), f"{VOICES_MENU_TEXT}\nCurrent: {active_voice}\nDefault voices:\tUser voices:")
-            await query.edit_message_text(reply, reply_markup=build_voices_list(update.effective_user, True))
+            await query.edit_message_text(reply, reply_markup=await build_voices_list(update.effective_user, True))
         except Exception as e:
             logger.error(msg="Exception while choose_setting: ", exc_info=e)
             reply_menu = get_text_locale(update.effective_user, get_cis_locale_dict(SETTINGS_MENU_TEXT_RU), SETTINGS_MENU_TEXT)
@@ -163,7 +186,7 @@ async def choose_setting(update: Update, context: CallbackContext) -> int:
 
     if data == SettingsMenuStates.select_samples.name:
         try:
-            samples_num = db_handle.get_user_samples_setting(update.effective_user.id)
+            samples_num = (await get_user_settings(update.effective_user.id)).samples_num
             reply = get_text_locale(update.effective_user, get_cis_locale_dict(f"{SAMPLES_MENU_TEXT_RU}\nТекущее: {samples_num}"), f"{SAMPLES_MENU_TEXT}\nCurrent: {samples_num}")
             await query.edit_message_text(reply, reply_markup=build_samples_menu(update.effective_user))
         except Exception as e:
@@ -175,10 +198,24 @@ async def choose_setting(update: Update, context: CallbackContext) -> int:
 
         return SettingsMenuStates.select_samples
 
+    if data == SettingsMenuStates.select_delivery.name:
+        try:
+            active_mode = get_delivery_mode_name(update.effective_user, (await get_user_settings(update.effective_user.id)).delivery_mode)
+            reply = get_text_locale(update.effective_user, get_cis_locale_dict(f"{DELIVERY_MENU_TEXT_RU}\nТекущий: {active_mode}"), f"{DELIVERY_MENU_TEXT}\nCurrent: {active_mode}")
+            await query.edit_message_text(reply, reply_markup=build_delivery_menu(update.effective_user))
+        except Exception as e:
+            logger.error(msg="Exception while choose_setting: ", exc_info=e)
+            reply_menu = get_text_locale(update.effective_user, get_cis_locale_dict(SETTINGS_MENU_TEXT_RU), SETTINGS_MENU_TEXT)
+            reply = get_text_locale(update.effective_user, get_cis_locale_dict(MENU_LOAD_ERR_RU), MENU_LOAD_ERR)
+            await report_error(query, reply_menu, reply)
+            return ConversationHandler.END
+
+        return SettingsMenuStates.select_delivery
+
     if data == SettingsMenuStates.remove_voice.name:
         try:
             reply = get_text_locale(update.effective_user, get_cis_locale_dict(f"{VOICES_MENU_TEXT_RU} (для удаления)"), f"{VOICES_MENU_TEXT} (to remove)")
-            await query.edit_message_text(reply, reply_markup=build_voices_list(update.effective_user, False))
+            await query.edit_message_text(reply, reply_markup=await build_voices_list(update.effective_user, False))
         except Exception as e:
             logger.error(msg="Exception while choose_setting: ", exc_info=e)
             reply_menu = get_text_locale(update.effective_user, get_cis_locale_dict(SETTINGS_MENU_TEXT_RU), SETTINGS_MENU_TEXT)
@@ -200,9 +237,9 @@ async def choose_voice(update: Update, context: CallbackContext) -> int:
         try:
             data_json = json.loads(data)
             if data_json["is_default"]:
-                db_handle.update_default_voice_setting(update.effective_user.id, data_json["data"])
+                await settings_cache.update_default_voice(update.effective_user.id, data_json["data"])
             else:
-                db_handle.update_user_voice_setting(update.effective_user.id, int(data_json["data"]))
+                await settings_cache.update_user_voice(update.effective_user.id, int(data_json["data"]))
         except Exception as e:
             logger.error(msg="Exception while choose_voice: ", exc_info=e)
             reply_menu = get_text_locale(update.effective_user, get_cis_locale_dict(SETTINGS_MENU_TEXT_RU), SETTINGS_MENU_TEXT)
@@ -220,7 +257,7 @@ async def choose_emotion(update: Update, context: CallbackContext) -> int:
     data = await get_query_data(query)
     if data != SettingsMenuStates.back.name:
         try:
-            db_handle.update_emot_setting(update.effective_user.id, EMOTION_STRINGS[data].value)
+            await settings_cache.update_emotion(update.effective_user.id, EMOTION_STRINGS[data])
         except Exception as e:
             logger.error(msg="Exception while choose_voice: ", exc_info=e)
             reply_menu = get_text_locale(update.effective_user, get_cis_locale_dict(SETTINGS_MENU_TEXT_RU), SETTINGS_MENU_TEXT)
@@ -238,7 +275,7 @@ async def choose_samples(update: Update, context: CallbackContext) -> int:
     data = await get_query_data(query)
     if data != SettingsMenuStates.back.name:
         try:
-            db_handle.update_user_samples_setting(update.effective_user.id, int(data))
+            await settings_cache.update_samples(update.effective_user.id, int(data))
         except Exception as e:
             logger.error(msg="Exception while choose_samples: ", exc_info=e)
             reply_menu = get_text_locale(update.effective_user, get_cis_locale_dict(SETTINGS_MENU_TEXT_RU), SETTINGS_MENU_TEXT)
@@ -251,6 +288,24 @@ async def choose_samples(update: Update, context: CallbackContext) -> int:
     return SettingsMenuStates.select_setting
 
 
+async def choose_delivery(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    data = await get_query_data(query)
+    if data != SettingsMenuStates.back.name:
+        try:
+            await settings_cache.update_delivery(update.effective_user.id, DeliveryModes[data])
+        except Exception as e:
+            logger.error(msg="Exception while choose_delivery: ", exc_info=e)
+            reply_menu = get_text_locale(update.effective_user, get_cis_locale_dict(SETTINGS_MENU_TEXT_RU), SETTINGS_MENU_TEXT)
+            reply = get_text_locale(update.effective_user, get_cis_locale_dict(MENU_SET_ERR_RU), MENU_SET_ERR)
+            await report_error(query, reply_menu, reply)
+            return ConversationHandler.END
+
+    reply = get_text_locale(update.effective_user, get_cis_locale_dict(SETTINGS_MENU_TEXT_RU), SETTINGS_MENU_TEXT)
+    await query.edit_message_text(reply, reply_markup=build_settings_menu(update.effective_user))
+    return SettingsMenuStates.select_setting
+
+
 async def rem_voice(update: Update, context: CallbackContext) -> int:
     # remove selected voice form db and delete voice folder
     query = update.callback_query
@@ -258,7 +313,9 @@ async def rem_voice(update: Update, context: CallbackContext) -> int:
     if data != SettingsMenuStates.back.name:
         try:
             data_json = json.loads(data)
-            voice_dir = db_handle.remove_user_voice(update.effective_user.id, int(data_json["data"]))
+            voice_dir = await db_async.remove_user_voice(update.effective_user.id, int(data_json["data"]))
+            settings_cache.invalidate(update.effective_user.id)  # active voice may be reset
+            remove_latents_file(os.path.basename(voice_dir), get_user_voice_dir(update.effective_user.id))
             shutil.rmtree(voice_dir)
         except Exception as e:
             logger.error(msg="Exception while rem_voice: ", exc_info=e)
@@ -292,8 +349,11 @@ def get_settings_menu_handler() -> ConversationHandler:
             SettingsMenuStates.select_voice: [CallbackQueryHandler(choose_voice, pattern=f"^{QUERY_PATTERN_SETTINGS}*")],
             SettingsMenuStates.select_emotion: [CallbackQueryHandler(choose_emotion, pattern=f"^{QUERY_PATTERN_SETTINGS}*")],
             SettingsMenuStates.select_samples: [CallbackQueryHandler(choose_samples, pattern=f"^{QUERY_PATTERN_SETTINGS}*")],
+            SettingsMenuStates.select_delivery: [CallbackQueryHandler(choose_delivery, pattern=f"^{QUERY_PATTERN_SETTINGS}*")],
             SettingsMenuStates.remove_voice: [CallbackQueryHandler(rem_voice, pattern=f"^{QUERY_PATTERN_SETTINGS}*")]
         },
-        fallbacks=[CallbackQueryHandler(retry_button, pattern=f"^{QUERY_PATTERN_RETRY}*"), CallbackQueryHandler(fallback)],
+        fallbacks=[CallbackQueryHandler(retry_button, pattern=f"^{QUERY_PATTERN_RETRY}*"),
+                   CallbackQueryHandler(cancel_button, pattern=f"^{QUERY_PATTERN_CANCEL}"),
+                   CallbackQueryHandler(fallback)],
         allow_reentry=True
     )
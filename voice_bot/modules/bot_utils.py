@@ -6,20 +6,39 @@ import os
 import configparser
 import unicodedata
 from functools import wraps
-from typing import Callable
-from tortoise.utils import audio
+from typing import Callable, List, Optional, Tuple
+from io import BytesIO
+from numpy import ndarray
+import numpy as np
+import soundfile as sf
+import tempfile
+import asyncio
 import string
+import time
+import importlib.util
 from os import makedirs
+try:
+    import av  # in-process opus encoding, ffmpeg is used if not available
+except ImportError:
+    av = None
 
 
+STARTED_AT = time.monotonic()  # to measure startup and time to first response
 MAX_CHARS_NUM = 300
+ADMISSION_PRUNE_SIZE = 1024  # number of user buckets to start dropping idle ones
 CONFIG_FILE_NAME = "config"
 SCRIPT_PATH = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../"))
 DATA_PATH = os.path.realpath(os.path.join(SCRIPT_PATH, "../bot_data"))
 RESULTS_PATH = os.path.join(DATA_PATH, "outputs")
 MODELS_PATH = os.path.join(DATA_PATH, "models")
 VOICES_PATH = os.path.join(DATA_PATH, "user_voices")
+# same as tortoise.utils.audio.BUILTIN_VOICES_DIR, without importing tortoise and torch at startup
+BUILTIN_VOICES_DIR = os.path.join(importlib.util.find_spec("tortoise").submodule_search_locations[0], "voices")
+VOICES_SHARDS = 256  # user voices folders are spread between shard folders to keep listings small
+VOICES_SHARD_PREFIX = "shard_"
+OPUS_FRAME_SIZE = 480  # 20ms at 24kHz
 QUERY_PATTERN_RETRY = "c_re"
+QUERY_PATTERN_CANCEL = "c_cn"
 SOURCE_WEB_LINK = "https://github.com/Helther/voice-pick-tbot"
 FOLDER_CHAR_LIMIT = 0
 
@@ -36,10 +55,35 @@ class Config(object):
     def __init__(self) -> None:
         self.token = ""
         self.user_id_set: set = set()
+        self.save_outputs = False
+        self.concurrent_updates = 32
+        self.workspace_ttl = 3600
+        self.workspaces_size = 1024 * 1024 * 1024
         self.keep_cache = False
         self.high_vram = True
         self.batch_size = None
-        self.device = 0
+        self.devices = [0]
+        self.warmup_text = "Hello."
+        self.backend_clip_timeout = 120
+        self.latents_cache_size = 32
+        self.batch_window = 0.05
+        self.queue_max_size = 100
+        self.user_max_queued_jobs = 5
+        self.user_max_active_jobs = 1
+        self.max_batch_jobs = 4
+        self.round_clips = 4
+        self.stt_workers = 1
+        self.quality_low_wait = 120
+        self.quality_high_wait = -1
+        self.quality_low_samples = 1
+        self.user_rate = 20 / 60
+        self.user_burst = 40
+        self.global_rate = 200 / 60
+        self.global_burst = 400
+        self.cost_chars = 100
+        self.result_cache_size = 512 * 1024 * 1024
+        self.clip_cache_memory_size = 256 * 1024 * 1024
+        self.clip_cache_disk_size = 1024 * 1024 * 1024
         self.default_voices = []
         makedirs(RESULTS_PATH, exist_ok=True)
         makedirs(MODELS_PATH, exist_ok=True)
@@ -60,14 +104,50 @@ class Config(object):
                 user_ids = user_id_str.split(",")
                 for id in user_ids:
                     self.user_id_set.add(int(id))  # if config invalid then terminate
+            self.save_outputs = config.getboolean(config_section_name, "SAVE_OUTPUTS", fallback=False)
+            self.concurrent_updates = config.getint(config_section_name, "CONCURRENT_UPDATES", fallback=32)
+            self.workspace_ttl = config.getint(config_section_name, "WORKSPACE_TTL_MIN", fallback=60) * 60
+            self.workspaces_size = config.getint(config_section_name, "WORKSPACES_SIZE_MB", fallback=1024) * 1024 * 1024
 
             config_section_name = "Tortoise"
             self.keep_cache = config.getboolean(config_section_name, "KEEP_CACHE")
             self.high_vram = config.getboolean(config_section_name, "HIGH_VRAM")
             self.batch_size = config.getint(config_section_name, "BATCH_SIZE", fallback=None)
-            self.device = config.getint(config_section_name, "DEVICE", fallback=0)
-
-        with os.scandir(audio.BUILTIN_VOICES_DIR) as it:
+            devices_str = config.get(config_section_name, "DEVICE", fallback="0").replace(" ", "")
+            self.devices = [int(device) for device in devices_str.split(",")]
+            self.latents_cache_size = config.getint(config_section_name, "LATENTS_CACHE_SIZE", fallback=32)
+            self.batch_window = config.getint(config_section_name, "BATCH_WINDOW_MS", fallback=50) / 1000
+            self.warmup_text = config.get(config_section_name, "WARMUP_TEXT", fallback="Hello.").strip()
+            self.backend_clip_timeout = config.getfloat(config_section_name, "CLIP_TIMEOUT_SEC", fallback=120)
+
+            config_section_name = "Queue"
+            self.queue_max_size = config.getint(config_section_name, "MAX_SIZE", fallback=100)
+            self.user_max_queued_jobs = config.getint(config_section_name, "USER_MAX_QUEUED", fallback=5)
+            self.user_max_active_jobs = config.getint(config_section_name, "USER_MAX_ACTIVE", fallback=1)
+            self.max_batch_jobs = config.getint(config_section_name, "MAX_BATCH_JOBS", fallback=4)
+            self.round_clips = config.getint(config_section_name, "ROUND_CLIPS", fallback=4)
+
+            config_section_name = "Whisper"
+            self.stt_workers = config.getint(config_section_name, "WORKERS", fallback=1)
+
+            config_section_name = "Quality"
+            self.quality_low_wait = config.getfloat(config_section_name, "LOW_QUALITY_WAIT", fallback=120)
+            self.quality_high_wait = config.getfloat(config_section_name, "HIGH_QUALITY_WAIT", fallback=-1)
+            self.quality_low_samples = config.getint(config_section_name, "LOW_QUALITY_SAMPLES", fallback=1)
+
+            config_section_name = "Limits"
+            self.user_rate = config.getfloat(config_section_name, "USER_RATE", fallback=20) / 60
+            self.user_burst = config.getfloat(config_section_name, "USER_BURST", fallback=40)
+            self.global_rate = config.getfloat(config_section_name, "GLOBAL_RATE", fallback=200) / 60
+            self.global_burst = config.getfloat(config_section_name, "GLOBAL_BURST", fallback=400)
+            self.cost_chars = config.getint(config_section_name, "COST_CHARS", fallback=100)
+
+            config_section_name = "Cache"
+            self.result_cache_size = config.getint(config_section_name, "RESULTS_SIZE_MB", fallback=512) * 1024 * 1024
+            self.clip_cache_memory_size = config.getint(config_section_name, "CLIPS_MEMORY_MB", fallback=256) * 1024 * 1024
+            self.clip_cache_disk_size = config.getint(config_section_name, "CLIPS_SIZE_MB", fallback=1024) * 1024 * 1024
+
+        with os.scandir(BUILTIN_VOICES_DIR) as it:
             for entry in it:
                 if not entry.name.startswith('.') and entry.is_dir():
                     self.default_voices.append(entry.name)
@@ -98,7 +178,7 @@ def log_cmd(user, name: str) -> None:
 
 
 def convert_to_voice(filename: str) -> str:
-    result_file = filename.replace('wav', 'ogg')
+    result_file = os.path.splitext(filename)[0] + '.ogg'
     convert_to_voice_cmd = f"ffmpeg -i {filename} -c:a libopus {result_file}"
     try:
         subprocess.run(f"{convert_to_voice_cmd}", shell=True, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
@@ -110,18 +190,80 @@ def convert_to_voice(filename: str) -> str:
     return result_file
 
 
-def convert_to_wav(filename: str) -> str:
-    result_file = filename.replace('ogg', 'wav')
-    convert_to_voice_cmd = f"ffmpeg -i {filename} -acodec pcm_s16le {result_file}"
+def encode_voice(pcm: ndarray, sample_rate: int) -> BytesIO:
+    """blocking, encode mono float pcm audio into in-memory ogg/opus voice file"""
+    buffer = BytesIO()
+    samples = (np.clip(pcm, -1., 1.) * 32767).astype(np.int16)
+    with av.open(buffer, mode="w", format="ogg") as container:
+        stream = container.add_stream("libopus", rate=sample_rate)
+        stream.codec_context.layout = "mono"
+        stream.codec_context.format = "s16"
+        frame_size = stream.codec_context.frame_size or OPUS_FRAME_SIZE
+        for start in range(0, len(samples), frame_size):
+            chunk = samples[start:start + frame_size]
+            if len(chunk) < frame_size:  # encoder requires full frames
+                chunk = np.pad(chunk, (0, frame_size - len(chunk)))
+            frame = av.AudioFrame.from_ndarray(chunk.reshape(1, -1), format="s16", layout="mono")
+            frame.sample_rate = sample_rate
+            frame.pts = start
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode(None):  # flush encoder
+            container.mux(packet)
+    buffer.seek(0)
+    return buffer
+
+
+def encode_voice_with_fallback(pcm: ndarray, sample_rate: int, scratch_dir: str) -> BytesIO:
+    """blocking, encode in-process if possible, otherwise convert temporary wav file in scratch_dir with ffmpeg"""
+    if av is not None:
+        try:
+            return encode_voice(pcm, sample_rate)
+        except Exception as e:
+            logger.error(msg="In-process voice encoding failed, falling back to ffmpeg", exc_info=e)
+    fd, wav_file = tempfile.mkstemp(suffix=".wav", dir=scratch_dir)
+    os.close(fd)
+    voice_file = None
     try:
-        subprocess.run(f"{convert_to_voice_cmd}", shell=True, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except Exception as e:
-        remove_temp_file(result_file)
-        raise Exception from e
+        sf.write(wav_file, pcm, sample_rate)
+        voice_file = convert_to_voice(wav_file)
+        if voice_file is None:
+            raise Exception(f"Failed to convert to voice: {wav_file}")
+        with open(voice_file, 'rb') as file:
+            return BytesIO(file.read())
     finally:
-        remove_temp_file(filename)
+        remove_temp_file(wav_file)
+        if voice_file:
+            remove_temp_file(voice_file)
+
+
+async def encode_voices(pcm_list: List[ndarray], sample_rate: int, scratch_dir: str) -> List[BytesIO]:
+    """encode candidates in parallel on executor, scratch_dir - workspace of the request for temporary files"""
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*[loop.run_in_executor(None, encode_voice_with_fallback, pcm, sample_rate, scratch_dir) for pcm in pcm_list])
+
+
+def decode_audio(buffer: BytesIO, sample_rate: Optional[int]) -> Tuple[ndarray, int]:
+    """blocking, decode (and resample if sample_rate is set) audio file data, returns mono audio and its sample rate"""
+    from librosa import load  # slow to import, keep it off the bot startup
+    buffer.seek(0)
+    return load(buffer, sr=sample_rate)
 
-    return result_file
+
+async def download_audio(bot, attachment) -> BytesIO:
+    """download voice or audio attachment of the message into memory"""
+    file = await bot.get_file(attachment)
+    buffer = BytesIO()
+    await file.download_to_memory(out=buffer)
+    buffer.seek(0)
+    return buffer
+
+
+async def download_and_decode_audio(bot, attachment, sample_rate: Optional[int]) -> Tuple[ndarray, int, BytesIO]:
+    """download attachment into memory and decode it on executor, returns audio, sample rate and file data"""
+    buffer = await download_audio(bot, attachment)
+    audio, sr = await asyncio.get_running_loop().run_in_executor(None, decode_audio, buffer, sample_rate)
+    return audio, sr, buffer
 
 
 def clear_dir(dir_name: str) -> None:
@@ -150,12 +292,89 @@ def user_restricted(func: Callable):
     return inner
 
 
+class TokenBucket(object):
+    """holds up to burst tokens, refills rate tokens per second"""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_wait_time(self, cost: float) -> float:
+        """seconds until cost tokens are available, call after refill"""
+        cost = min(cost, self.burst)  # request bigger than burst passes with full bucket
+        return 0. if self.tokens >= cost else (cost - self.tokens) / self.rate
+
+    def is_full(self) -> bool:
+        return self.tokens >= self.burst
+
+
+class AdmissionControl(object):
+    """
+    Rate limiting of synthesis requests with per-user and global token buckets,
+    request cost is text length in COST_CHARS units times number of samples,
+    used from the event loop only
+    """
+    def __init__(self) -> None:
+        self.user_buckets: dict = {}
+        self.global_bucket: Optional[TokenBucket] = None
+        self.prune_size = ADMISSION_PRUNE_SIZE
+
+    def get_cost(self, text_len: int, samples_num: int) -> float:
+        return max(1, -(-text_len // config.cost_chars)) * samples_num
+
+    def try_admit(self, user_id: int, cost: float) -> float:
+        """consume tokens and return 0 if request is admitted, otherwise return seconds to wait"""
+        now = time.monotonic()
+        if self.global_bucket is None:  # created when config is loaded
+            self.global_bucket = TokenBucket(config.global_rate, config.global_burst)
+        user_bucket = self.user_buckets.get(user_id, None)
+        if user_bucket is None:
+            self.prune(now)
+            user_bucket = self.user_buckets[user_id] = TokenBucket(config.user_rate, config.user_burst)
+        user_bucket.refill(now)
+        self.global_bucket.refill(now)
+        wait_time = max(user_bucket.get_wait_time(cost), self.global_bucket.get_wait_time(cost))
+        if wait_time > 0:
+            return wait_time
+        user_bucket.tokens -= min(cost, user_bucket.burst)
+        self.global_bucket.tokens -= min(cost, self.global_bucket.burst)
+        return 0.
+
+    def prune(self, now: float) -> None:
+        """drop buckets that are full again, they are the same as new ones, keeps memory bounded"""
+        if len(self.user_buckets) < self.prune_size:
+            return
+        for user_id, bucket in list(self.user_buckets.items()):
+            bucket.refill(now)
+            if bucket.is_full():
+                del self.user_buckets[user_id]
+        self.prune_size = max(ADMISSION_PRUNE_SIZE, 2 * len(self.user_buckets))  # amortized if most users are active
+
+
+admission = AdmissionControl()
+
+
 def get_emot_string(emot: str) -> str:
     return f"[I am really {emot},]"
 
 
+def get_voices_shard_name(shard_ind: int) -> str:
+    return f"{VOICES_SHARD_PREFIX}{shard_ind:02x}"
+
+
+def get_voices_shard(user_id: int) -> str:
+    return get_voices_shard_name(user_id % VOICES_SHARDS)
+
+
 def get_user_voice_dir(user_id: int) -> str:
-    voices_dir = os.path.normpath(os.path.join(VOICES_PATH, str(user_id)))
+    voices_dir = os.path.normpath(os.path.join(VOICES_PATH, get_voices_shard(user_id), str(user_id)))
     if not os.path.exists(voices_dir):
         os.makedirs(voices_dir)
     return voices_dir
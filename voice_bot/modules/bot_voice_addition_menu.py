@@ -13,18 +13,23 @@ from voice_bot.modules.bot_utils import (
     logger,
     sanitize_filename,
     get_user_voice_dir,
-    convert_to_wav,
+    download_and_decode_audio,
     get_text_locale,
-    get_cis_locale_dict
+    get_cis_locale_dict,
+    QUERY_PATTERN_CANCEL
 )
-from voice_bot.modules.bot_db import db_handle
+from voice_bot.modules.bot_db import db_async
+from voice_bot.modules.bot_handlers import cancel_button
+from voice_bot.modules.voice_cache import remove_latents_file
 from voice_bot.modules.bot_settings import MAX_USER_VOICES_COUNT
 from enum import Enum
 import os
 import shutil
-from tortoise.utils.audio import read_audio_file
 from voice_bot.modules.bot_settings_menu import report_error
-from librosa import get_duration, load
+from functools import partial
+from io import BytesIO
+import soundfile as sf
+import asyncio
 
 
 VOICE_DURATION_MIN = 15  # seconds
@@ -59,6 +64,11 @@ class AddVoiceUserData(Enum):
         data.pop(AddVoiceUserData.audio_duration.name, None)
 
 
+def write_file(file_path: str, buffer: BytesIO) -> None:
+    with open(file_path, mode='wb') as file:
+        file.write(buffer.getbuffer())
+
+
 def create_accept_button(user: User) -> InlineKeyboardButton:
     acc_str = get_text_locale(user, get_cis_locale_dict("Принять"), "Accept")
     return InlineKeyboardButton(acc_str, callback_data=VoiceMenuStates.accept.name)
@@ -76,7 +86,7 @@ def create_markup(user: User) -> InlineKeyboardMarkup:
 @user_restricted
 async def add_voice_main_cmd(update: Update, context: CallbackContext) -> int:
     # create setting message and provide buttons if addition is possible
-    voices = db_handle.get_user_voices(update.effective_user.id)
+    voices = await db_async.get_user_voices(update.effective_user.id)
     if len(voices) >= MAX_USER_VOICES_COUNT:
         reply = get_text_locale(update.effective_user, get_cis_locale_dict((f"{VOICE_ADDITION_MENU_TEXT_RU}\nОшибка: вы превысили максимальное число пользовательских голосов: {MAX_USER_VOICES_COUNT}\n"
                                                                             "Пожалуйста удалите лишний голос через меню /settings и попробуйте снова")),
@@ -104,25 +114,18 @@ async def get_audio_files(update: Update, context: CallbackContext) -> int:
             os.makedirs(new_voice_dir)
         current_duration = context.user_data.get(AddVoiceUserData.audio_duration.name, 0)
         duration = 0
-        if update.message.voice:  # validate voice file
-            filetype = ".ogg"
+        loop = asyncio.get_running_loop()
+        if update.message.voice:  # validate voice file, store as wav
+            filetype = ".wav"
             file_path += filetype
-            with open(file_path, mode='w'):
-                pass
-            file = await context.bot.get_file(update.message.voice)
-            await file.download_to_drive(file_path)
-            audio, lsr = load(file_path, sr=None)
-            duration = get_duration(audio, lsr)
-
-            file_path = convert_to_wav(file_path)
-        else:  # should be wav or mp3 audio
+            audio, lsr, _ = await download_and_decode_audio(context.bot, update.message.voice, None)
+            duration = len(audio) / lsr
+            await loop.run_in_executor(None, partial(sf.write, file_path, audio, lsr, subtype="PCM_16"))
+        else:  # should be wav or mp3 audio, stored as is
             filetype = update.message.audio.file_name[-4:]
             file_path += filetype
-            with open(file_path, mode='w'):
-                pass
-            file = await context.bot.get_file(update.message.audio)
-            await file.download_to_drive(file_path)
-            read_audio_file(file_path)
+            _, _, buffer = await download_and_decode_audio(context.bot, update.message.audio, None)
+            await loop.run_in_executor(None, write_file, file_path, buffer)
             duration = update.message.audio.duration
 
         context.user_data[AddVoiceUserData.audio_duration.name] = current_duration + duration
@@ -142,7 +145,7 @@ async def get_voice_name(update: Update, context: CallbackContext) -> int:
     # get and verify voice name
     try:
         name = sanitize_filename(update.message.text)
-        user_voices = db_handle.get_user_voices(update.effective_user.id)  # (id, name) pairs or None if no voices
+        user_voices = await db_async.get_user_voices(update.effective_user.id)  # (id, name) pairs or None if no voices
         user_voices = [name for id, name in user_voices]
         assert name and (user_voices is None or name not in user_voices)
         context.user_data[AddVoiceUserData.voice_name.name] = name
@@ -191,8 +194,9 @@ async def accept(update: Update, context: CallbackContext) -> int:
             return await destroy_add_voice_menu(update, context)
 
         name = context.user_data[AddVoiceUserData.voice_name.name]
-        db_handle.insert_user_voice(update.effective_user.id, name,
-                                    os.path.join(get_user_voice_dir(update.effective_user.id), name))
+        voices_dir = get_user_voice_dir(update.effective_user.id)
+        remove_latents_file(name, voices_dir)  # drop leftovers of a removed voice with the same name
+        await db_async.insert_user_voice(update.effective_user.id, name, os.path.join(voices_dir, name))
         reply = get_text_locale(update.effective_user, get_cis_locale_dict(f"{VOICE_ADDITION_MENU_TEXT_RU}\nНовый голос был успешно добавлен: {name}"),
                                 f"{VOICE_ADDITION_MENU_TEXT}\nSuccessfully added new voice: {name}")
         await query.edit_message_text(reply)
@@ -253,5 +257,5 @@ def get_add_voice_menu_handler() -> ConversationHandler:
             VoiceMenuStates.get_name.value: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_voice_name),
                                              CallbackQueryHandler(cancel, pattern=VoiceMenuStates.cancel.name)]
         },
-        fallbacks=[CallbackQueryHandler(fallback)]
+        fallbacks=[CallbackQueryHandler(cancel_button, pattern=f"^{QUERY_PATTERN_CANCEL}"), CallbackQueryHandler(fallback)]
     )
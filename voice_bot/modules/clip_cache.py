@@ -0,0 +1,184 @@
+import os
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from typing import TYPE_CHECKING, List, Optional
+import numpy as np
+from voice_bot.modules.bot_utils import DATA_PATH, config, logger
+from voice_bot.modules.voice_cache import get_voice_fingerprint, resolve_voice_dir
+if TYPE_CHECKING:
+    from torch import Tensor
+
+
+CLIP_CACHE_PATH = os.path.join(DATA_PATH, "cache", "clips")
+CLIP_FILE_SUFFIX = ".npy"
+STATS_LOG_INTERVAL = 100  # lookups
+CACHE_FORMAT_VERSION = 2  # bump to drop entries made by incompatible synthesis code
+
+
+def normalize_clip_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def get_voice_hash(voice: str, user_voices_dir: str) -> Optional[str]:
+    """identifies voice samples, None for random voice which clips are never cached"""
+    owner, voice_dir = resolve_voice_dir(voice, user_voices_dir)
+    if voice_dir is None:
+        return None
+    return f"{owner}/{voice}/{get_voice_fingerprint(voice_dir)}"
+
+
+def get_clip_key(clip: str, voice_hash: str, emotion: str, preset: str, candidate: int) -> str:
+    inputs = (CACHE_FORMAT_VERSION, normalize_clip_text(clip), voice_hash, emotion, preset, candidate)
+    return hashlib.sha256(repr(inputs).encode()).hexdigest()
+
+
+class ClipCache(object):
+    """
+    Two-tier (in-memory and on-disk .npy files) LRU cache of synthesized clips pcm audio,
+    so that texts sharing sentences with previous ones only synthesize the new sentences
+    Thread-safe, each tier has its own size budget, counts hits for statistics
+    """
+    def __init__(self) -> None:
+        self.memory_entries: OrderedDict = OrderedDict()  # key: tensor
+        self.memory_size = 0
+        self.disk_entries: OrderedDict = OrderedDict()  # key: file size
+        self.disk_size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        os.makedirs(CLIP_CACHE_PATH, exist_ok=True)
+
+    def is_enabled(self) -> bool:
+        return config.clip_cache_memory_size > 0 or config.clip_cache_disk_size > 0
+
+    def load_index(self) -> None:
+        """blocking, restore disk tier from files, least recently used first"""
+        files = []
+        with os.scandir(CLIP_CACHE_PATH) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(CLIP_FILE_SUFFIX):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.name[:-len(CLIP_FILE_SUFFIX)], stat.st_size))
+        files.sort()
+        with self.lock:
+            for _, key, size in files:
+                self.disk_entries[key] = size
+                self.disk_size += size
+            self.evict_disk()
+
+    def get_candidates(self, keys: List[str]) -> Optional[List["Tensor"]]:
+        """blocking, returns audio of every key (candidate) or None if any of them is missing"""
+        result = []
+        for key in keys:
+            audio = self.get(key)
+            if audio is None:
+                return None
+            result.append(audio)
+        return result
+
+    def get(self, key: str) -> Optional["Tensor"]:
+        with self.lock:
+            audio = self.memory_entries.get(key, None)
+            if audio is not None:
+                self.memory_entries.move_to_end(key)
+                self.count(hit=True)
+                return audio
+            on_disk = key in self.disk_entries
+            if on_disk:
+                self.disk_entries.move_to_end(key)
+            else:
+                self.count(hit=False)
+                return None
+
+        try:
+            import torch  # imported on first disk hit, not at bot startup
+            audio = torch.from_numpy(np.load(self.get_file(key)))
+            os.utime(self.get_file(key))  # keep lru order between restarts
+        except Exception as e:
+            logger.error(msg=f"Failed to load cached clip: {key}", exc_info=e)
+            with self.lock:
+                self.drop_disk_entry(key)
+                self.count(hit=False)
+            return None
+        with self.lock:
+            self.disk_hits += 1
+            self.count(hit=True)
+            self.put_memory(key, audio)
+        return audio
+
+    def put(self, key: str, audio: "Tensor") -> None:
+        """blocking, store clip audio in both tiers"""
+        audio = audio.cpu()
+        if audio.is_shared():  # cached clips shouldn't hold shared memory file descriptors
+            audio = audio.clone()
+        with self.lock:
+            self.put_memory(key, audio)
+            if config.clip_cache_disk_size <= 0:
+                return
+        file = self.get_file(key)
+        temp_file = f"{file}.tmp"
+        try:
+            with open(temp_file, 'wb') as temp:
+                np.save(temp, audio.numpy())
+            os.replace(temp_file, file)
+        except Exception as e:
+            logger.error(msg=f"Failed to store clip into cache: {key}", exc_info=e)
+            try:
+                os.remove(temp_file)
+            except FileNotFoundError:
+                pass
+            return
+        with self.lock:
+            size = os.path.getsize(file)
+            self.disk_size -= self.disk_entries.pop(key, 0)  # replaced by regeneration
+            self.disk_entries[key] = size
+            self.disk_size += size
+            self.evict_disk()
+
+    # following methods should be called with the lock held
+
+    def put_memory(self, key: str, audio: "Tensor") -> None:
+        size = audio.element_size() * audio.nelement()
+        if size > config.clip_cache_memory_size:
+            return
+        old_audio = self.memory_entries.pop(key, None)
+        if old_audio is not None:
+            self.memory_size -= old_audio.element_size() * old_audio.nelement()
+        self.memory_entries[key] = audio
+        self.memory_size += size
+        while self.memory_size > config.clip_cache_memory_size:
+            _, old_audio = self.memory_entries.popitem(last=False)
+            self.memory_size -= old_audio.element_size() * old_audio.nelement()
+
+    def evict_disk(self) -> None:
+        while self.disk_size > config.clip_cache_disk_size and self.disk_entries:
+            self.drop_disk_entry(next(iter(self.disk_entries)))
+
+    def drop_disk_entry(self, key: str) -> None:
+        size = self.disk_entries.pop(key, None)
+        if size is None:
+            return
+        self.disk_size -= size
+        try:
+            os.remove(self.get_file(key))
+        except FileNotFoundError:
+            pass
+
+    def count(self, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        lookups = self.hits + self.misses
+        if lookups % STATS_LOG_INTERVAL == 0:
+            logger.info(f"Clip cache: {self.hits}/{lookups} hits ({self.disk_hits} from disk), "
+                        f"memory: {self.memory_size // 1024}KB, disk: {self.disk_size // 1024}KB")
+
+    @staticmethod
+    def get_file(key: str) -> str:
+        return os.path.join(CLIP_CACHE_PATH, key + CLIP_FILE_SUFFIX)
+
+
+clip_cache = ClipCache()
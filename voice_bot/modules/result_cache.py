@@ -0,0 +1,157 @@
+import os
+import json
+import hashlib
+import asyncio
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Optional, Union
+from voice_bot.modules.bot_utils import DATA_PATH, config, logger
+from voice_bot.modules.voice_cache import get_voice_fingerprint, resolve_voice_dir
+
+
+RESULT_CACHE_PATH = os.path.join(DATA_PATH, "cache", "results")
+INDEX_FILE_NAME = "index.json"
+CACHE_FORMAT_VERSION = 2  # bump to drop entries made by incompatible synthesis code
+
+
+def get_result_key(text: str, voice: str, user_voices_dir: str, emotion: str, candidates: int, preset: str) -> Optional[str]:
+    """
+    hash of the synthesis inputs, voice is identified by its samples fingerprint,
+    None if result is not reproducible (random voice)
+    """
+    owner, voice_dir = resolve_voice_dir(voice, user_voices_dir)
+    if voice_dir is None:
+        return None
+    inputs = (CACHE_FORMAT_VERSION, text, owner, voice, get_voice_fingerprint(voice_dir), emotion, candidates, preset)
+    return hashlib.sha256(repr(inputs).encode()).hexdigest()
+
+
+class ResultCache(object):
+    """
+    Size-bounded LRU cache of encoded voice replies on disk, keyed by get_result_key,
+    keeps telegram file_id of every sent candidate to re-send it without uploading,
+    blocking methods are thread-safe, in_flight is used from the event loop only
+    """
+    def __init__(self) -> None:
+        self.entries: OrderedDict = OrderedDict()  # key: {"size": int, "file_ids": [str or None]}
+        self.size = 0
+        self.lock = Lock()
+        self.in_flight: Dict[str, asyncio.Future] = {}  # key: future resolved when the synthesis is done
+        os.makedirs(RESULT_CACHE_PATH, exist_ok=True)
+
+    def is_enabled(self) -> bool:
+        return config.result_cache_size > 0
+
+    def load_index(self) -> None:
+        """blocking, restore entries whose files are still present"""
+        index_file = os.path.join(RESULT_CACHE_PATH, INDEX_FILE_NAME)
+        try:
+            with open(index_file, 'r') as file:
+                index = json.load(file)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(msg="Failed to load result cache index", exc_info=e)
+            return
+        with self.lock:
+            for key, entry in index:
+                if all(os.path.exists(self.get_file(key, ind)) for ind in range(len(entry["file_ids"]))):
+                    self.entries[key] = entry
+                    self.size += entry["size"]
+            self.evict()
+
+    def get(self, key: str) -> Optional[List[Union[str, bytes]]]:
+        """blocking, returns file_id or encoded data of every candidate, None on miss"""
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            file_ids = list(entry["file_ids"])
+        voices = []
+        try:
+            for ind, file_id in enumerate(file_ids):
+                if file_id:
+                    voices.append(file_id)
+                else:
+                    with open(self.get_file(key, ind), 'rb') as file:
+                        voices.append(file.read())
+        except OSError as e:
+            logger.error(msg="Failed to read cached result", exc_info=e)
+            self.remove(key)
+            return None
+        return voices
+
+    def put(self, key: str, voices: List[bytes]) -> None:
+        """blocking, store encoded candidates, evict least recently used entries to fit the size limit"""
+        size = sum(len(voice) for voice in voices)
+        if size > config.result_cache_size:
+            return
+        try:
+            for ind, voice in enumerate(voices):
+                with open(self.get_file(key, ind), 'wb') as file:
+                    file.write(voice)
+        except OSError as e:
+            logger.error(msg="Failed to store result into cache", exc_info=e)
+            return
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry["size"]
+            self.entries[key] = {"size": size, "file_ids": [None] * len(voices)}
+            self.size += size
+            self.evict()
+            self.save_index()
+
+    def set_file_ids(self, key: str, file_ids: List[Optional[str]]) -> None:
+        """blocking, remember telegram file ids of the sent candidates"""
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None or len(entry["file_ids"]) != len(file_ids):
+                return
+            merged_ids = [new_id or old_id for new_id, old_id in zip(file_ids, entry["file_ids"])]
+            if merged_ids == entry["file_ids"]:  # re-sent by file id, nothing new to save
+                return
+            entry["file_ids"] = merged_ids
+            self.save_index()
+
+    def remove(self, key: str) -> None:
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return
+            self.size -= entry["size"]
+            self.remove_files(key, entry)
+            self.save_index()
+
+    # following methods should be called with the lock held
+
+    def evict(self) -> None:
+        while self.size > config.result_cache_size and self.entries:
+            key, entry = self.entries.popitem(last=False)
+            self.size -= entry["size"]
+            self.remove_files(key, entry)
+
+    def remove_files(self, key: str, entry: dict) -> None:
+        for ind in range(len(entry["file_ids"])):
+            try:
+                os.remove(self.get_file(key, ind))
+            except FileNotFoundError:
+                pass
+
+    def save_index(self) -> None:
+        index_file = os.path.join(RESULT_CACHE_PATH, INDEX_FILE_NAME)
+        temp_file = f"{index_file}.tmp"
+        try:
+            with open(temp_file, 'w') as file:
+                json.dump(list(self.entries.items()), file)
+            os.replace(temp_file, index_file)
+        except Exception as e:
+            logger.error(msg="Failed to save result cache index", exc_info=e)
+
+    @staticmethod
+    def get_file(key: str, candidate: int) -> str:
+        return os.path.join(RESULT_CACHE_PATH, f"{key}_{candidate}.ogg")
+
+
+result_cache = ResultCache()
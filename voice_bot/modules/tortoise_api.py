@@ -1,52 +1,183 @@
-import tortoise.api
-from tortoise.utils import audio
-import torchaudio
-from torch.cuda import empty_cache
-from torch import cat
-from typing import List, Tuple
-from tortoise.utils.text import split_and_recombine_text
-from voice_bot.modules.bot_utils import MODELS_PATH, config, get_emot_string
-
-
-# init tts models
-tts = tortoise.api.TextToSpeech(high_vram=config.high_vram, autoregressive_batch_size=config.batch_size, device=config.device)
-
-
-def run_tts_on_text(filename: str, text: str, voice: str, user_voices_dir: str, candidates: int) -> List[Tuple]:
-    """save result into file with filename, returns audio data and filename pairs"""
-    result = []
-    voice_samples, conditioning_latents = audio.load_voice(voice, [user_voices_dir])
-    pcm_audio = tts.tts_with_preset(text, voice_samples=voice_samples, conditioning_latents=conditioning_latents, preset="ultra_fast", k=candidates)
-    pcm_audio = pcm_audio if candidates > 1 else [pcm_audio]
-    for candidate_ind, sample in enumerate(pcm_audio):
-        sample_file = f"{filename}_{candidate_ind}.wav"
-        sample = sample.squeeze(0).cpu()
-        torchaudio.save(sample_file, sample, 24000)
-        result.append(sample)
-
-    return result
-
-
-def tts_audio_from_text(filename_result: str, text: str, voice: str, user_voices_dir: str, emotion: str, candidates: int) -> None:
-    clipname_result = filename_result.replace(".wav", "")
-    clips = split_and_recombine_text(text)
-    audio_clips = []
-    try:
-        for clip_ind, clip in enumerate(clips):
-            clip_name = f"{clipname_result}_{clip_ind}"
-            if emotion:
-                clip = "".join([get_emot_string(emotion), clip])
-            samples_data = run_tts_on_text(clip_name, clip, voice, user_voices_dir, candidates)
-            audio_clips.append(samples_data)
+import torch
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+from torch import Tensor
+import inspect
+from typing import Callable, Dict, List, Tuple
+from voice_bot.modules.batch_sizer import BatchSizer
+from voice_bot.modules.bot_utils import config, logger
+from voice_bot.modules.tts_clips import DEFAULT_PRESET, SAMPLE_RATE
+from voice_bot.modules.voice_cache import latents_cache
+
+
+MAX_MEL_TOKENS = 500
+CALM_TOKEN = 83  # token for coding silence, used to trim trailing silence
+# bot presets: name -> (tortoise preset, scale of its autoregressive samples and diffusion iterations),
+# settings are taken from the installed tortoise, so that batched synthesis matches tts_with_preset
+PRESETS = {
+    "fast": ("fast", 1.),
+    "ultra_fast": ("ultra_fast", 1.),
+    "degraded": ("ultra_fast", .5),  # for overload
+}
+
 
-        for cand_ind in range(candidates):
-            cand_clips = []
-            for clip_ind in range(len(clips)):
-                cand_clips.append(audio_clips[clip_ind][cand_ind])
+def trim_calm_latents(codes: Tensor, latents: Tensor) -> Tensor:
+    """cut latents at the first long run of silence tokens"""
+    calm_tokens = 0
+    for token_ind in range(codes.shape[-1]):
+        if codes[token_ind] == CALM_TOKEN:
+            calm_tokens += 1
+        else:
+            calm_tokens = 0
+        if calm_tokens > 8:
+            return latents[:, :token_ind]
+    return latents
 
-            audio_combined = cat(cand_clips, dim=-1)
-            torchaudio.save(f"{clipname_result}_{cand_ind}.wav", audio_combined, 24000)
 
+def get_tortoise_preset(tts, preset: str) -> Dict:
+    """
+    generation settings tts_with_preset of the installed tortoise passes to tts for the preset,
+    defaults of tts parameters for the rest
+    """
+    settings = {name: param.default for name, param in inspect.signature(tts.tts).parameters.items()
+                if param.default is not inspect.Parameter.empty}
+
+    def capture(text, **preset_settings) -> None:
+        settings.update(preset_settings)
+
+    tts.tts = capture  # instance attribute shadows the method
+    try:
+        tts.tts_with_preset("", preset=preset)
     finally:
-        if not config.keep_cache:
-            empty_cache()
+        del tts.tts
+    return settings
+
+
+def load_presets(tts) -> Dict[str, Dict]:
+    presets = {}
+    for name, (tortoise_preset, scale) in PRESETS.items():
+        settings = get_tortoise_preset(tts, tortoise_preset)
+        for key in ("num_autoregressive_samples", "diffusion_iterations"):
+            settings[key] = max(int(settings[key] * scale), 1)
+        presets[name] = settings
+    return presets
+
+
+def get_supported_kwargs(func: Callable, **kwargs) -> Dict:
+    """kwargs accepted by func, tortoise forks differ in diffusion arguments (e.g. sampler)"""
+    params = inspect.signature(func).parameters
+    return {name: value for name, value in kwargs.items() if name in params and value is not None}
+
+
+class TortoiseBackend(object):
+    """
+    tortoise model instance on a single device,
+    tortoise.api is imported here, so that only tts backend process loads it
+    """
+    def __init__(self, device: int) -> None:
+        import tortoise.api
+        self.device = device
+        self.tts = tortoise.api.TextToSpeech(high_vram=config.high_vram, autoregressive_batch_size=config.batch_size, device=device)
+        # configured (or detected) batch size is the upper bound, lowered per input length on out of memory errors
+        self.batch_sizer = BatchSizer(self.tts.autoregressive_batch_size, on_oom=self.empty_cache)
+        self.presets = load_presets(self.tts)
+
+    def get_voice_latents(self, voice: str, user_voices_dir: str) -> Tuple:
+        """returns cached conditioning latents, None for random voice, raises if voice is not found"""
+        return latents_cache.get(voice, user_voices_dir, self.tts.get_conditioning_latents)
+
+    def prebake_default_voices(self) -> None:
+        """compute and store on disk latents for every built-in voice, fast if done already"""
+        for voice in config.default_voices:
+            try:
+                self.get_voice_latents(voice, None)
+            except Exception as e:
+                logger.error(msg=f"Failed to prepare latents for default voice: {voice}", exc_info=e)
+
+    def empty_cache(self) -> None:
+        if torch.cuda.is_available():
+            with torch.cuda.device(self.device):
+                torch.cuda.empty_cache()
+
+    def synthesize(self, texts: List[str], voice: str, user_voices_dir: str, candidates: List[int], preset: str = DEFAULT_PRESET) -> List[List[Tensor]]:
+        """synthesize texts with the voice in one batch, see tts_batch"""
+        try:
+            return self.tts_batch(texts, self.get_voice_latents(voice, user_voices_dir), candidates, preset)
+        finally:
+            if not config.keep_cache:
+                self.empty_cache()
+
+    @torch.inference_mode()
+    def tts_batch(self, texts: List[str], conditioning_latents: Tuple, candidates: List[int], preset: str = DEFAULT_PRESET) -> List[List[Tensor]]:
+        """
+        synthesize all texts with the same voice, autoregressive samples of every text
+        are packed together into batches, their size is picked by input length (see BatchSizer)
+        candidates - number of candidates for each text
+        returns list of candidates pcm audio for each text
+        """
+        from tortoise.api import do_spectrogram_diffusion, fix_autoregressive_output, load_discrete_vocoder_diffuser
+        settings = self.presets[preset]
+        if conditioning_latents is None:
+            conditioning_latents = self.tts.get_random_conditioning_latents()
+        auto_conditioning, diffusion_conditioning = (latent.to(self.tts.device) for latent in conditioning_latents)
+        samples_per_text = max(settings["num_autoregressive_samples"], max(candidates))
+        stop_mel_token = self.tts.autoregressive.stop_mel_token
+        text_tokens = [F.pad(torch.IntTensor(self.tts.tokenizer.encode(text)).to(self.tts.device), (0, 1)) for text in texts]
+
+        # one row per autoregressive sample, texts of similar length go together to minimize padding
+        rows = [text_ind for text_ind in sorted(range(len(texts)), key=lambda ind: text_tokens[ind].shape[-1]) for _ in range(samples_per_text)]
+        text_codes = [[] for _ in texts]
+        row_lengths = [text_tokens[text_ind].shape[-1] for text_ind in rows]
+
+        def run_batch(batch_rows: List[int]) -> None:
+            batch_tokens = pad_sequence([text_tokens[text_ind] for text_ind in batch_rows], batch_first=True)
+            codes = autoregressive.inference_speech(auto_conditioning.repeat(len(batch_rows), 1), batch_tokens,
+                                                    do_sample=True,
+                                                    top_p=settings["top_p"],
+                                                    temperature=settings["temperature"],
+                                                    num_return_sequences=1,
+                                                    length_penalty=settings["length_penalty"],
+                                                    repetition_penalty=settings["repetition_penalty"],
+                                                    max_generate_length=MAX_MEL_TOKENS)
+            codes = F.pad(codes, (0, MAX_MEL_TOKENS - codes.shape[1]), value=stop_mel_token)
+            for text_ind, row_codes in zip(batch_rows, codes):
+                text_codes[text_ind].append(fix_autoregressive_output(row_codes, stop_mel_token, complain=False))
+
+        with self.tts.temporary_cuda(self.tts.autoregressive) as autoregressive:
+            self.batch_sizer.run(rows, row_lengths, run_batch)
+
+        diffuser = load_discrete_vocoder_diffuser(**get_supported_kwargs(load_discrete_vocoder_diffuser,
+                                                                         desired_diffusion_steps=settings["diffusion_iterations"],
+                                                                         cond_free=settings["cond_free"],
+                                                                         cond_free_k=settings["cond_free_k"],
+                                                                         sampler=settings.get("sampler", None)))
+        result = []
+        for text, tokens, codes, text_candidates in zip(texts, text_tokens, text_codes, candidates):
+            codes = torch.stack(codes)
+            tokens = tokens.unsqueeze(0)
+            if codes.shape[0] > text_candidates:  # pick the best candidates, same as tortoise does
+                with self.tts.temporary_cuda(self.tts.clvp) as clvp:
+                    scores = clvp(tokens.repeat(codes.shape[0], 1), codes, return_loss=False)
+                codes = codes[torch.topk(scores, k=text_candidates).indices]
+
+            with self.tts.temporary_cuda(self.tts.autoregressive) as autoregressive:
+                latents = autoregressive(auto_conditioning.repeat(text_candidates, 1), tokens.repeat(text_candidates, 1),
+                                         torch.tensor([tokens.shape[-1]], device=tokens.device), codes,
+                                         torch.tensor([codes.shape[-1] * autoregressive.mel_length_compression], device=tokens.device),
+                                         return_latent=True, clip_inputs=False)
+
+            wav_candidates = []
+            with self.tts.temporary_cuda(self.tts.diffusion) as diffusion, self.tts.temporary_cuda(self.tts.vocoder) as vocoder:
+                for cand_codes, cand_latents in zip(codes, latents):
+                    cand_latents = trim_calm_latents(cand_codes, cand_latents.unsqueeze(0))
+                    mel = do_spectrogram_diffusion(diffusion, diffuser, cand_latents, diffusion_conditioning,
+                                                   **get_supported_kwargs(do_spectrogram_diffusion,
+                                                                          temperature=settings["diffusion_temperature"],
+                                                                          verbose=False))
+                    wav = vocoder.inference(mel)
+                    if self.tts.enable_redaction:  # remove bracketed (emotion) text from the speech
+                        wav = self.tts.aligner.redact(wav.squeeze(1), text, SAMPLE_RATE).unsqueeze(1)
+                    wav_candidates.append(wav.squeeze(0).cpu())
+            result.append(wav_candidates)
+
+        return result
@@ -0,0 +1,38 @@
+from typing import List, Tuple
+from tortoise.utils.text import split_and_recombine_text
+from voice_bot.modules.bot_utils import get_emot_string
+from voice_bot.modules.voice_cache import resolve_voice_dir
+
+
+# synthesis helpers used by the bot process, torch is imported only when synthesized audio is handled,
+# so that the bot starts serving without loading it, model code is in tortoise_api
+SAMPLE_RATE = 24000
+DEFAULT_PRESET = "ultra_fast"
+
+
+def get_voice_key(voice: str, user_voices_dir: str) -> Tuple:
+    """identifies voice latents, clips with the same key can be synthesized together, None for random voice"""
+    owner, voice_dir = resolve_voice_dir(voice, user_voices_dir)
+    return (owner, voice) if voice_dir else None
+
+
+def split_clips(text: str, emotion: str) -> List[str]:
+    """split text into clips suitable for synthesis, prepend emotion string to every clip"""
+    clips = split_and_recombine_text(text)
+    if emotion:
+        clips = ["".join([get_emot_string(emotion), clip]) for clip in clips]
+    return clips
+
+
+def combine_clips(audio_clips: List[List], candidates: int) -> List:
+    """concatenate clips pcm audio (tensors) of each candidate"""
+    from torch import cat
+    return [cat([clip_candidates[cand_ind] for clip_candidates in audio_clips], dim=-1) for cand_ind in range(candidates)]
+
+
+def save_candidates(filename_result: str, audio_clips: List[List], candidates: int) -> None:
+    """save combined audio of every candidate into {filename_result}_{candidate}.wav"""
+    import torchaudio
+    clipname_result = filename_result.replace(".wav", "")
+    for cand_ind, audio_combined in enumerate(combine_clips(audio_clips, candidates)):
+        torchaudio.save(f"{clipname_result}_{cand_ind}.wav", audio_combined, SAMPLE_RATE)
@@ -0,0 +1,107 @@
+import multiprocessing
+from multiprocessing.connection import Connection
+from threading import Lock
+from typing import List, Optional
+from voice_bot.modules.bot_utils import config, logger
+
+
+PROCESS_START_METHOD = "spawn"  # required for cuda in child processes
+
+
+def run_backend_process(conn: Connection, device: int, parent_config) -> None:
+    """
+    Child process entry point, loads the model once and serves (method, args) requests
+    replies with ("ok", result) or ("error", exception), first reply is ("ready", None) after model load
+    """
+    config.__dict__.update(parent_config.__dict__)  # spawned process doesn't share parent's loaded config
+    from voice_bot.modules.tortoise_api import TortoiseBackend
+    import torch.multiprocessing  # noqa: F401 registers tensor reductions to pass results via shared memory
+
+    backend = TortoiseBackend(device)
+    conn.send(("ready", None))
+    while True:
+        try:
+            method, args = conn.recv()
+        except EOFError:  # parent is gone
+            return
+        try:
+            result = getattr(backend, method)(*args)
+        except Exception as e:
+            try:
+                conn.send(("error", e))
+            except Exception:  # exception is not picklable
+                conn.send(("error", Exception(repr(e))))
+        else:
+            conn.send(("ok", result))
+
+
+class ProcessBackend(object):
+    """
+    Proxy to TortoiseBackend running in a child process, so that inference doesn't hold
+    the GIL of the bot process, requests and results are passed through a pipe,
+    child process is restarted if it crashes or doesn't reply in time (e.g. hangs in cuda),
+    current request fails in that case
+    """
+    def __init__(self, device: int) -> None:
+        self.device = device
+        self.process = None
+        self.conn = None
+        self.lock = Lock()
+        self.start_process()
+
+    def start_process(self) -> None:
+        """blocking, start child process and wait for its model to load"""
+        import torch.multiprocessing  # noqa: F401 registers tensor reductions to receive results via shared memory
+        context = multiprocessing.get_context(PROCESS_START_METHOD)
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(target=run_backend_process, args=(child_conn, self.device, config),
+                                       name=f"tts_backend_{self.device}", daemon=True)
+        self.process.start()
+        child_conn.close()  # so that recv fails when the child dies
+        self.conn = parent_conn
+        status, _ = self.conn.recv()
+        if status != "ready":
+            raise Exception(f"tts backend process on device {self.device} failed to start")
+        logger.info(f"TTS backend process started on device {self.device} with pid {self.process.pid}")
+
+    def restart_process(self, reason: str) -> None:
+        logger.error(f"TTS backend process on device {self.device} {reason}, restarting")
+        self.stop_process()
+        self.start_process()
+
+    def stop_process(self) -> None:
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+
+    def call(self, method: str, *args, timeout: Optional[float] = None):
+        """blocking, timeout - seconds to wait for the reply, None to wait as long as the process is alive"""
+        with self.lock:
+            try:
+                self.conn.send((method, args))
+                replied = self.conn.poll(timeout)
+                if replied:
+                    status, result = self.conn.recv()
+            except (EOFError, OSError) as e:
+                self.restart_process(f"died with exit code {self.process.exitcode}")
+                raise Exception(f"tts backend process crashed while running {method}") from e
+            if not replied:
+                self.restart_process(f"didn't reply to {method} in {timeout:.0f}s")
+                raise Exception(f"tts backend process timed out while running {method}")
+        if status == "error":
+            raise result
+        return result
+
+    def prebake_default_voices(self) -> None:
+        self.call("prebake_default_voices")
+
+    def synthesize(self, texts: List[str], voice: str, user_voices_dir: str, candidates: List[int], *args):
+        result = self.call("synthesize", texts, voice, user_voices_dir, candidates, *args,
+                           timeout=config.backend_clip_timeout * sum(candidates))
+        # received tensors are in shared memory, each keeps a file descriptor open while it's alive,
+        # copies into private memory are kept by clip cache and jobs instead
+        return [[audio.clone() for audio in text_audio] for text_audio in result]
@@ -0,0 +1,39 @@
+from typing import Optional
+from voice_bot.modules.bot_utils import config, logger
+from voice_bot.modules.tts_clips import DEFAULT_PRESET
+
+
+class QualityLevel(object):
+    """synthesis parameters of a load level, max_candidates - limit of user samples number, None for no limit"""
+    def __init__(self, name: str, preset: str, max_candidates: Optional[int]) -> None:
+        self.name = name
+        self.preset = preset
+        self.max_candidates = max_candidates
+
+
+QUALITY_HIGH = QualityLevel("high", "fast", None)
+QUALITY_NORMAL = QualityLevel("normal", DEFAULT_PRESET, None)
+QUALITY_LOW = QualityLevel("low", "degraded", 1)
+
+
+def choose_quality(backlog_time: float) -> QualityLevel:
+    """
+    map estimated time to synthesize queued jobs (queued clips times recent clip latency, shared by ready workers)
+    to the quality level,
+    quality is lowered when the backlog exceeds the wait target and raised when there is (almost) no backlog
+    """
+    if backlog_time > config.quality_low_wait:
+        return QUALITY_LOW
+    if config.quality_high_wait >= 0 and backlog_time <= config.quality_high_wait:
+        return QUALITY_HIGH
+    return QUALITY_NORMAL
+
+
+def apply_quality(job, quality: QualityLevel) -> None:
+    """set job synthesis parameters of the quality level, level is recorded in the job"""
+    job.quality = quality.name
+    job.preset = quality.preset
+    if quality.max_candidates is not None:
+        job.candidates = min(job.candidates, max(quality.max_candidates, config.quality_low_samples))
+    if quality is not QUALITY_NORMAL:
+        logger.info(f"Job {job.job_id} runs at {quality.name} quality, preset: {job.preset}, samples: {job.candidates}")
@@ -0,0 +1,265 @@
+import time
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from threading import Condition
+from typing import Callable, Dict, List, Optional, Tuple
+import os
+from voice_bot.modules.bot_utils import RESULTS_PATH, config, get_emot_string
+from voice_bot.modules.tts_clips import DEFAULT_PRESET, get_voice_key, split_clips
+from voice_bot.modules.tts_quality import QUALITY_NORMAL, apply_quality, choose_quality
+
+
+CLIP_TIME_ESTIMATE = 10.0  # seconds, initial estimate of ETA before any clip is synthesized, quality isn't lowered by it
+CLIP_TIME_SMOOTHING = 0.2
+
+
+class QueueFullError(Exception):
+    """job admission is rejected, user_limit is True if the user has too many queued jobs"""
+    def __init__(self, user_limit: bool) -> None:
+        super().__init__("user queue limit reached" if user_limit else "queue is full")
+        self.user_limit = user_limit
+
+
+class JobCancelledError(Exception):
+    """job is cancelled by the user"""
+    def __init__(self) -> None:
+        super().__init__("job is cancelled")
+
+
+class QueueClosedError(Exception):
+    """synthesis is unavailable, e.g. no tts worker could start"""
+
+
+job_ids = itertools.count(1)
+
+
+class TTSJob(object):
+    """
+    synthesis request of a single user, result is kept in memory (and saved into files named after filename_result in debug mode)
+    workspace - scratch directory of the request, owned by the caller
+    clips are synthesized in order, possibly interleaved with clips of other jobs
+    future is resolved by tts worker
+    clip_callback - optional callable(start, end, pcm list) called on tts worker thread
+    when clips [start, end) are ready, used for progressive delivery
+    use_cache - take clips synthesized by previous jobs from the clip cache, regeneration doesn't use it
+    """
+    def __init__(self, user, workspace, text: str, settings, user_voices_dir: str, use_cache: bool = True) -> None:
+        self.job_id = next(job_ids)
+        self.user = user
+        self.user_id: int = user.id
+        self.workspace = workspace
+        self.filename_result = os.path.join(RESULTS_PATH, f"{os.path.basename(workspace.path)}.wav")  # unique like workspace
+        self.text = text
+        self.voice = settings.voice
+        self.user_voices_dir = user_voices_dir
+        self.emotion = settings.emotion
+        self.candidates = settings.samples_num
+        self.preset = DEFAULT_PRESET
+        self.quality = QUALITY_NORMAL.name  # chosen by load when the job starts
+        self.clips: List[str] = split_clips(text, self.emotion)
+        self.audio_clips: List = [None] * len(self.clips)
+        self.result_audio: List = []  # pcm audio of every candidate
+        self.use_cache = use_cache
+        self.voice_hash: Optional[str] = None  # set by tts worker if clips can be cached
+        self.next_clip = 0
+        self.done_clips = 0
+        self.started_at: Optional[float] = None
+        self.cancelled = False  # set for running job, tts worker drops it at the next clip boundary
+        self.clip_callback: Optional[Callable] = None
+        self.delivered_clips = 0
+        self.future = Future()
+
+    def estimate_clips(self) -> int:
+        """number of clips left to synthesize"""
+        return max(len(self.clips) - self.done_clips, 1)
+
+    def skip_ready_clips(self) -> None:
+        """move next_clip past clips taken from the cache"""
+        while self.next_clip < len(self.clips) and self.audio_clips[self.next_clip] is not None:
+            self.next_clip += 1
+
+    def has_pending_clips(self) -> bool:
+        return self.next_clip < len(self.clips)
+
+    def is_complete(self) -> bool:
+        return self.done_clips == len(self.clips)
+
+    def get_clip_text(self, clip_ind: int) -> str:
+        """clip text without the emotion prefix"""
+        clip = self.clips[clip_ind]
+        if self.emotion:
+            return clip[len(get_emot_string(self.emotion)):]
+        return clip
+
+    def get_batch_key(self) -> Tuple:
+        """clips of jobs with the same key can be synthesized in one batch"""
+        voice_key = get_voice_key(self.voice, self.user_voices_dir)
+        if voice_key is None:  # random voice latents differ for every job
+            voice_key = id(self)
+        return voice_key, self.preset, self.emotion
+
+
+class TTSJobQueue(object):
+    """
+    Thread-safe bounded queue of synthesis jobs
+    jobs are taken in round-robin order between users, limited by per-user active jobs count
+    """
+    def __init__(self) -> None:
+        self.user_queues: Dict[int, deque] = OrderedDict()  # rotation order of users
+        self.active: Dict[int, List[TTSJob]] = {}
+        self.size = 0
+        self.clip_time = CLIP_TIME_ESTIMATE
+        self.clip_time_measured = False
+        self.workers = 1  # number of ready tts workers synthesizing queued jobs in parallel
+        self.closed: Optional[QueueClosedError] = None
+        self.cond = Condition()
+
+    def put(self, job: TTSJob) -> None:
+        """raises QueueFullError if job is not admitted, QueueClosedError if the queue is closed"""
+        with self.cond:
+            if self.closed is not None:
+                raise self.closed
+            user_queue = self.user_queues.get(job.user_id, None)
+            if user_queue is not None and len(user_queue) >= config.user_max_queued_jobs:
+                raise QueueFullError(True)
+            if self.size >= config.queue_max_size:
+                raise QueueFullError(False)
+            if user_queue is None:
+                user_queue = self.user_queues[job.user_id] = deque()
+            user_queue.append(job)
+            self.size += 1
+            self.cond.notify()
+
+    def get_batch(self, max_jobs: int, block: bool = True) -> List[TTSJob]:
+        """
+        takes up to max_jobs jobs round-robin between users
+        if block - waits for eligible jobs and for batch window to pass, otherwise returns what's available,
+        returns empty list when the queue is closed
+        """
+        with self.cond:
+            if block:
+                self.cond.wait_for(lambda: self.closed is not None or self.has_eligible())
+                # let simultaneous requests gather, notifications of put and task_done don't end the window
+                deadline = time.monotonic() + config.batch_window
+                remaining = config.batch_window
+                while remaining > 0 and self.closed is None:
+                    self.cond.wait(remaining)
+                    remaining = deadline - time.monotonic()
+            if self.closed is not None:
+                return []
+            batch = []
+            while len(batch) < max_jobs:
+                job = self.pop_next()
+                if job is None:
+                    break
+                batch.append(job)
+            return batch
+
+    def close(self, exc: QueueClosedError) -> None:
+        """fail queued jobs with exc and reject new ones, workers waiting for jobs get none"""
+        with self.cond:
+            if self.closed is not None:
+                return
+            self.closed = exc
+            for user_queue in self.user_queues.values():
+                for job in user_queue:
+                    job.future.set_exception(exc)
+            self.user_queues.clear()
+            self.size = 0
+            self.cond.notify_all()
+
+    def task_done(self, job: TTSJob) -> None:
+        """release job user slot"""
+        with self.cond:
+            active = self.active.get(job.user_id, [])
+            if job in active:
+                active.remove(job)
+            if not active:
+                self.active.pop(job.user_id, None)
+            self.cond.notify()
+
+    def cancel(self, job: TTSJob) -> bool:
+        """remove queued job or mark running one to be dropped by tts worker, returns False if job is done already"""
+        with self.cond:
+            if job.future.done():
+                return False
+            user_queue = self.user_queues.get(job.user_id, None)
+            if user_queue is not None and job in user_queue:
+                user_queue.remove(job)
+                if not user_queue:
+                    del self.user_queues[job.user_id]
+                self.size -= 1
+                job.future.set_exception(JobCancelledError())
+            else:
+                job.cancelled = True
+            return True
+
+    def report_clip_time(self, clip_time: float) -> None:
+        """update estimated time of single clip synthesis"""
+        with self.cond:
+            if not self.clip_time_measured:
+                self.clip_time = clip_time
+                self.clip_time_measured = True
+            else:
+                self.clip_time += CLIP_TIME_SMOOTHING * (clip_time - self.clip_time)
+
+    def set_workers(self, workers: int) -> None:
+        """set number of ready tts workers, time estimates are divided between them"""
+        with self.cond:
+            self.workers = max(workers, 1)
+
+    def get_position(self, job: TTSJob) -> Tuple[int, float]:
+        """returns (place in queue starting from 1, ETA in seconds), place is 0 if job is running already"""
+        with self.cond:
+            if job.started_at is not None:
+                return 0, 0.
+            ahead_clips = sum(active_job.estimate_clips() for jobs in self.active.values() for active_job in jobs)
+            position = 0
+            for queued_job in self.iter_order():
+                if queued_job is job:
+                    break
+                position += 1
+                ahead_clips += queued_job.estimate_clips()
+            # clips ahead are shared by workers, job itself runs on a single one
+            return position + 1, (ahead_clips / self.workers + job.estimate_clips()) * self.clip_time
+
+    # following methods should be called with the lock held
+
+    def has_eligible(self) -> bool:
+        return any(self.is_eligible(user_id) for user_id in self.user_queues)
+
+    def is_eligible(self, user_id: int) -> bool:
+        return len(self.active.get(user_id, [])) < config.user_max_active_jobs
+
+    def pop_next(self) -> Optional[TTSJob]:
+        for user_id in list(self.user_queues.keys()):
+            if not self.is_eligible(user_id):
+                continue
+            user_queue = self.user_queues.pop(user_id)
+            job = user_queue.popleft()
+            if user_queue:
+                self.user_queues[user_id] = user_queue  # to the end of rotation
+            self.size -= 1
+            self.active.setdefault(user_id, []).append(job)
+            job.started_at = time.monotonic()
+            apply_quality(job, choose_quality(self.get_backlog_time()) if self.clip_time_measured else QUALITY_NORMAL)
+            return job
+        return None
+
+    def get_backlog_time(self) -> float:
+        """estimated time to synthesize the queued jobs by all workers"""
+        queued_clips = sum(job.estimate_clips() for user_queue in self.user_queues.values() for job in user_queue)
+        return queued_clips * self.clip_time / self.workers
+
+    def iter_order(self):
+        """queued jobs in the order they are expected to be taken"""
+        user_queues = [list(user_queue) for user_queue in self.user_queues.values()]
+        depth = max((len(user_queue) for user_queue in user_queues), default=0)
+        for ind in range(depth):
+            for user_queue in user_queues:
+                if ind < len(user_queue):
+                    yield user_queue[ind]
+
+
+tts_queue = TTSJobQueue()
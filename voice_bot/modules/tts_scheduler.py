@@ -0,0 +1,306 @@
+import time
+from threading import Thread, Lock
+from typing import Callable, Dict, List, Optional, Tuple
+from voice_bot.modules.bot_utils import STARTED_AT, config, logger
+from voice_bot.modules.clip_cache import clip_cache, get_clip_key, get_voice_hash
+from voice_bot.modules.tts_clips import DEFAULT_PRESET, combine_clips, save_candidates
+from voice_bot.modules.tts_process import ProcessBackend
+from voice_bot.modules.tts_queue import JobCancelledError, QueueClosedError, TTSJob, TTSJobQueue, tts_queue
+from voice_bot.modules.voice_cache import RANDOM_VOICE
+
+
+class TTSScheduler(object):
+    """
+    Runs on tts worker thread, keeps a set of active jobs taken from the pool queue
+    and synthesizes them clip by clip in rounds, every round takes clips from active jobs in turns,
+    so short jobs are done in between clips of long ones,
+    compatible clips of different jobs are synthesized together
+    backend - object providing synthesize method, see TortoiseBackend
+    """
+    def __init__(self, pool: "TTSWorkerPool", backend) -> None:
+        self.pool = pool
+        self.backend = backend
+        self.active_jobs: List[TTSJob] = []
+        self.load = (0, 0)  # (active jobs, clips left) published for other workers, guarded by the pool lock
+
+    def run(self) -> None:
+        while not self.pool.stopped:
+            self.admit_jobs()
+            round_jobs = list(self.active_jobs)
+            try:
+                self.process_round()
+            except Exception as e:
+                logger.error(msg="Exception while processing synthesis jobs:", exc_info=e)
+                for job in round_jobs:
+                    self.fail_job(job, e)
+        for job in list(self.active_jobs):
+            self.fail_job(job, QueueClosedError("tts worker is stopped"))
+
+    def publish_load(self) -> None:
+        """called by the worker thread when its jobs change, other workers read the load under the pool lock"""
+        load = (len(self.active_jobs), sum(job.estimate_clips() for job in self.active_jobs))
+        with self.pool.lock:
+            self.load = load
+
+    def admit_jobs(self) -> None:
+        """take new jobs from the queue, wait for them only if there is nothing else to do"""
+        self.publish_load()
+        capacity = config.max_batch_jobs - len(self.active_jobs)
+        if capacity <= 0:
+            return
+        for job in self.pool.request_jobs(self, capacity, block=not self.active_jobs):
+            if not job.clips:
+                self.fail_job(job, Exception("No text to synthesize"))
+                continue
+            self.active_jobs.append(job)
+            try:
+                self.take_cached_clips(job)
+            except Exception as e:
+                logger.error(msg="Exception while looking up clip cache:", exc_info=e)
+        self.publish_load()
+
+    def take_cached_clips(self, job: TTSJob) -> None:
+        """fill job clips synthesized by previous jobs, only the rest is synthesized"""
+        if not clip_cache.is_enabled():
+            return
+        job.voice_hash = get_voice_hash(job.voice, job.user_voices_dir)
+        if job.voice_hash is None or not job.use_cache:
+            return
+        for clip_ind, clip in enumerate(job.clips):
+            keys = [get_clip_key(clip, job.voice_hash, job.emotion, job.preset, cand_ind) for cand_ind in range(job.candidates)]
+            clip_candidates = clip_cache.get_candidates(keys)
+            if clip_candidates is not None:
+                job.audio_clips[clip_ind] = clip_candidates
+                job.done_clips += 1
+        job.skip_ready_clips()
+        if job.done_clips:
+            logger.debug(f"Took {job.done_clips} of {len(job.clips)} clips from the cache")
+
+    def take_round_units(self) -> List[Tuple[TTSJob, int]]:
+        """
+        returns (job, clip index) units for this round, active jobs get clips in turns,
+        progressive job gets a single clip until its first part is delivered
+        """
+        units = []
+        jobs = [job for job in self.active_jobs if job.has_pending_clips()]
+        while jobs and len(units) < config.round_clips:
+            for job in jobs:
+                if len(units) >= config.round_clips:
+                    break
+                units.append((job, job.next_clip))
+                job.next_clip += 1
+                job.skip_ready_clips()
+            jobs = [job for job in jobs if job.has_pending_clips() and not self.awaits_first_part(job)]
+        return units
+
+    @staticmethod
+    def awaits_first_part(job: TTSJob) -> bool:
+        return job.clip_callback is not None and job.delivered_clips == 0
+
+    def process_round(self) -> None:
+        """blocking, synthesize round clips grouped by batch key, finish completed jobs"""
+        started_at = time.monotonic()
+        self.drop_cancelled_jobs()
+        round_units = self.take_round_units()
+        groups: Dict[Tuple, List[Tuple[TTSJob, int]]] = {}
+        for job, clip_ind in round_units:
+            groups.setdefault(job.get_batch_key(), []).append((job, clip_ind))
+
+        # groups with first parts go first, clips are delivered as soon as their group is done
+        for units in sorted(groups.values(), key=lambda units: not any(self.awaits_first_part(job) for job, _ in units)):
+            units = [(job, clip_ind) for job, clip_ind in units if not job.future.done() and not job.cancelled]
+            if not units:  # cancelled in the meantime
+                continue
+            try:
+                self.process_group(units)
+            except Exception as e:
+                for job in set(job for job, _ in units):
+                    self.fail_job(job, e)
+            for job in set(job for job, _ in units if job.clip_callback is not None):
+                self.deliver_clips(job)
+        if round_units:
+            self.pool.queue.report_clip_time((time.monotonic() - started_at) / len(round_units))
+
+        for job in [job for job in self.active_jobs if job.clip_callback is not None]:  # clips taken from the cache
+            self.deliver_clips(job)
+        for job in [job for job in self.active_jobs if job.is_complete()]:
+            self.finish_job(job)
+
+    def drop_cancelled_jobs(self) -> None:
+        """free the device for other jobs at clip boundary"""
+        for job in [job for job in self.active_jobs if job.cancelled]:
+            logger.debug(f"Dropping cancelled job of user: {job.user_id}")
+            self.fail_job(job, JobCancelledError())
+
+    def process_group(self, units: List[Tuple[TTSJob, int]]) -> None:
+        head = units[0][0]
+        texts = [job.clips[clip_ind] for job, clip_ind in units]
+        candidates = [job.candidates for job, _ in units]
+        if len(set(job for job, _ in units)) > 1:
+            logger.debug(f"Synthesizing {len(texts)} clips of different jobs in one batch")
+
+        results = self.backend.synthesize(texts, head.voice, head.user_voices_dir, candidates, head.preset)
+        for (job, clip_ind), clip_candidates in zip(units, results):
+            job.audio_clips[clip_ind] = clip_candidates
+            job.done_clips += 1
+            self.store_clip(job, clip_ind)
+
+    def store_clip(self, job: TTSJob, clip_ind: int) -> None:
+        if job.voice_hash is None:
+            return
+        try:
+            for cand_ind, audio in enumerate(job.audio_clips[clip_ind]):
+                clip_cache.put(get_clip_key(job.clips[clip_ind], job.voice_hash, job.emotion, job.preset, cand_ind), audio)
+        except Exception as e:
+            logger.error(msg="Exception while storing clip into cache:", exc_info=e)
+
+    def deliver_clips(self, job: TTSJob) -> None:
+        """pass newly ready clips following the already delivered ones to the job callback"""
+        end = job.delivered_clips
+        while end < len(job.audio_clips) and job.audio_clips[end] is not None:
+            end += 1
+        if end == job.delivered_clips or job.future.done():
+            return
+        try:
+            pcm = [audio.squeeze(0).numpy() for audio in combine_clips(job.audio_clips[job.delivered_clips:end], job.candidates)]
+            job.clip_callback(job.delivered_clips, end, pcm)
+        except Exception as e:
+            logger.error(msg="Exception while delivering synthesized clips:", exc_info=e)
+        job.delivered_clips = end
+
+    def finish_job(self, job: TTSJob) -> None:
+        """concatenate clips of the complete job, keep candidates pcm as job result, save to disk in debug mode"""
+        try:
+            job.result_audio = [audio.squeeze(0).numpy() for audio in combine_clips(job.audio_clips, job.candidates)]
+            if config.save_outputs:
+                save_candidates(job.filename_result, job.audio_clips, job.candidates)
+        except Exception as e:
+            self.fail_job(job, e)
+        else:
+            job.future.set_result(None)
+            self.release_job(job)
+
+    def fail_job(self, job: TTSJob, exc: Exception) -> None:
+        if job.future.done():  # already finished or failed
+            return
+        job.future.set_exception(exc)
+        self.release_job(job)
+
+    def release_job(self, job: TTSJob) -> None:
+        if job in self.active_jobs:
+            self.active_jobs.remove(job)
+        job.audio_clips = []  # free audio data of the finished job
+        self.pool.queue.task_done(job)
+        self.publish_load()
+
+
+WARMUP_VOICE = RANDOM_VOICE  # doesn't need voice samples
+
+
+class TTSWorker(Thread):
+    """
+    Thread with its own synthesis backend (model instance on a single device) and scheduler,
+    backend is created on the thread, so that workers load their models in parallel,
+    jobs wait in the queue until some worker is ready
+    """
+    def __init__(self, pool: "TTSWorkerPool", device: int, backend_factory: Callable, prebake: bool) -> None:
+        Thread.__init__(self, name=f"tts_worker_{device}", daemon=True)  # Doesn't matter if stops unexpectedly
+        self.pool = pool
+        self.device = device
+        self.backend_factory = backend_factory
+        self.prebake = prebake
+        self.scheduler: Optional[TTSScheduler] = None
+        self.failed = False
+
+    def run(self) -> None:
+        try:
+            backend = self.backend_factory(self.device)
+            if self.prebake:
+                backend.prebake_default_voices()
+        except Exception as e:
+            logger.error(msg=f"Failed to initialize tts worker on device: {self.device}", exc_info=e)
+            self.pool.on_worker_failed(self)
+            return
+        if config.warmup_text:
+            self.warm_up(backend)
+        self.scheduler = TTSScheduler(self.pool, backend)
+        self.pool.on_worker_ready()
+        logger.info(f"TTS worker on device {self.device} is ready in {time.monotonic() - STARTED_AT:.1f}s since start")
+        self.scheduler.run()
+
+    def warm_up(self, backend) -> None:
+        """synthesize a short text to prime kernels and memory allocators before the first request"""
+        started_at = time.monotonic()
+        try:
+            backend.synthesize([config.warmup_text], WARMUP_VOICE, None, [1], DEFAULT_PRESET)
+        except Exception as e:
+            logger.error(msg=f"Warm-up synthesis failed on device: {self.device}", exc_info=e)
+        else:
+            logger.info(f"Warm-up synthesis on device {self.device} took {time.monotonic() - started_at:.1f}s")
+
+
+class TTSWorkerPool(object):
+    """
+    Dispatcher of queue jobs between workers, one worker per device,
+    a job goes to the least loaded worker which has free capacity
+    backend_factory - callable(device) returning synthesis backend
+    """
+    def __init__(self, backend_factory: Callable = ProcessBackend, queue: TTSJobQueue = tts_queue) -> None:
+        self.backend_factory = backend_factory
+        self.queue = queue
+        self.workers: List[TTSWorker] = []
+        self.stopped = False
+        self.lock = Lock()
+
+    def start(self, devices: List[int]) -> None:
+        with self.lock:
+            for ind, device in enumerate(devices):
+                worker = TTSWorker(self, device, self.backend_factory, prebake=ind == 0)
+                self.workers.append(worker)
+                worker.start()
+
+    def is_ready(self) -> bool:
+        """at least one worker has loaded its model"""
+        with self.lock:
+            return any(worker.scheduler is not None for worker in self.workers)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """blocking, fail queued and running jobs and wait for workers to finish their current round"""
+        with self.lock:
+            self.stopped = True
+            workers = list(self.workers)
+        self.queue.close(QueueClosedError("tts is stopped"))
+        for worker in workers:
+            worker.join(timeout)
+
+    def on_worker_ready(self) -> None:
+        with self.lock:
+            ready = sum(worker.scheduler is not None for worker in self.workers)
+        self.queue.set_workers(ready)
+
+    def on_worker_failed(self, failed_worker: TTSWorker) -> None:
+        """jobs can't be synthesized if every worker has failed to start, they are failed instead of waiting forever"""
+        with self.lock:
+            failed_worker.failed = True
+            all_failed = all(worker.failed for worker in self.workers)
+        if all_failed:
+            logger.error("No tts worker could start, synthesis requests are rejected")
+            self.queue.close(QueueClosedError("no tts worker could start"))
+
+    def request_jobs(self, scheduler: TTSScheduler, max_jobs: int, block: bool) -> List[TTSJob]:
+        """
+        called by worker scheduler, blocking request is made by idle worker,
+        busy worker gets jobs only if there is no less loaded worker to take them
+        """
+        if not block and not self.is_least_loaded(scheduler):
+            return []
+        return self.queue.get_batch(max_jobs, block)
+
+    def is_least_loaded(self, scheduler: TTSScheduler) -> bool:
+        with self.lock:
+            _, load = scheduler.load
+            others = [worker.scheduler.load for worker in self.workers if worker.scheduler not in (None, scheduler)]
+        return all(load <= other_clips for other_jobs, other_clips in others if other_jobs < config.max_batch_jobs)
+
+
+tts_worker_pool = TTSWorkerPool()
@@ -0,0 +1,140 @@
+import os
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Optional, Tuple
+from voice_bot.modules.bot_utils import BUILTIN_VOICES_DIR, MODELS_PATH, config, logger
+
+
+BUILTIN_VOICES_OWNER = "builtin"
+RANDOM_VOICE = "random"  # tortoise generates random latents for it
+LATENTS_FILE_SUFFIX = ".latents.pth"
+BUILTIN_LATENTS_PATH = os.path.join(MODELS_PATH, "latents")
+
+
+def resolve_voice_dir(voice: str, user_voices_dir: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """
+    returns (owner, voice_dir) pair for the voice, user voices take precedence over the built-in ones
+    (same order tortoise uses), owner is user id string or BUILTIN_VOICES_OWNER, (None, None) if not found
+    """
+    if user_voices_dir:
+        voice_dir = os.path.join(user_voices_dir, voice)
+        if os.path.isdir(voice_dir):
+            return os.path.basename(os.path.normpath(user_voices_dir)), voice_dir
+    voice_dir = os.path.join(BUILTIN_VOICES_DIR, voice)
+    if os.path.isdir(voice_dir):
+        return BUILTIN_VOICES_OWNER, voice_dir
+    return None, None
+
+
+def get_latents_file(owner: str, voice: str, voice_dir: str) -> str:
+    """on-disk latents are stored next to the voice folder, built-in ones - in models dir"""
+    if owner == BUILTIN_VOICES_OWNER:
+        return os.path.join(BUILTIN_LATENTS_PATH, voice + LATENTS_FILE_SUFFIX)
+    return os.path.normpath(voice_dir) + LATENTS_FILE_SUFFIX
+
+
+def get_voice_fingerprint(voice_dir: str) -> str:
+    """hash of voice sample files names, sizes and modification times"""
+    entries = []
+    with os.scandir(voice_dir) as it:
+        for entry in it:
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                entries.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    entries.sort()
+    return hashlib.sha1(repr(entries).encode()).hexdigest()
+
+
+def remove_latents_file(voice: str, user_voices_dir: str) -> None:
+    """
+    remove on-disk latents of the user voice, called by the bot process when the voice is removed or added,
+    memory tiers of tts backends don't need invalidation (see LatentsCache)
+    """
+    owner = os.path.basename(os.path.normpath(user_voices_dir))
+    try:
+        os.remove(get_latents_file(owner, voice, os.path.join(user_voices_dir, voice)))
+    except FileNotFoundError:
+        pass
+
+
+class LatentsCache(object):
+    """
+    Two-tier (in-memory LRU and on-disk .pth files) cache of voice conditioning latents
+    keyed by (owner, voice name, voice samples fingerprint)
+    Thread-safe, latents are stored on cpu, used by tts backend processes, each has its own memory tier,
+    entries of changed or removed voices are never hit, since the fingerprint differs, and are evicted by lru
+    """
+    def __init__(self) -> None:
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = Lock()
+        os.makedirs(BUILTIN_LATENTS_PATH, exist_ok=True)
+
+    def get(self, voice: str, user_voices_dir: Optional[str], compute: Callable) -> Optional[Tuple]:
+        """
+        returns cached conditioning latents for the voice,
+        compute - callable(voice_samples) -> latents, called on cache miss
+        returns None for random voice, raises if voice is not found (e.g. removed while the job was queued)
+        """
+        owner, voice_dir = resolve_voice_dir(voice, user_voices_dir)
+        if voice_dir is None:
+            if voice == RANDOM_VOICE:
+                return None
+            raise Exception(f"Voice is not found: {voice}")
+        fingerprint = get_voice_fingerprint(voice_dir)
+        key = (owner, voice, fingerprint)
+        with self.lock:
+            latents = self.entries.get(key, None)
+            if latents is not None:
+                self.entries.move_to_end(key)
+                return latents
+
+        latents_file = get_latents_file(owner, voice, voice_dir)
+        latents = self.load_from_disk(latents_file, fingerprint)
+        if latents is None:
+            from tortoise.utils import audio  # only used by tts backend
+            voice_samples, latents = audio.load_voice(voice, [user_voices_dir] if user_voices_dir else None)
+            if latents is None:  # voice provided as samples, not as precomputed latents
+                latents = compute(voice_samples)
+            latents = tuple(latent.cpu() for latent in latents)
+            self.save_to_disk(latents_file, fingerprint, latents)
+
+        with self.lock:
+            self.drop_voice_entries(owner, voice)  # only one actual version of the voice is kept
+            self.entries[key] = latents
+            while len(self.entries) > config.latents_cache_size:
+                self.entries.popitem(last=False)
+        return latents
+
+    def drop_voice_entries(self, owner: str, voice: str) -> None:
+        # lock should be held by the caller
+        for key in [key for key in self.entries if key[0] == owner and key[1] == voice]:
+            del self.entries[key]
+
+    def load_from_disk(self, latents_file: str, fingerprint: str) -> Optional[Tuple]:
+        if not os.path.exists(latents_file):
+            return None
+        try:
+            import torch  # only used by tts backend
+            data = torch.load(latents_file, map_location="cpu")
+            if data["fingerprint"] == fingerprint:
+                return tuple(data["latents"])
+        except Exception as e:
+            logger.error(msg=f"Failed to load cached voice latents: {latents_file}", exc_info=e)
+        return None
+
+    def save_to_disk(self, latents_file: str, fingerprint: str, latents: Tuple) -> None:
+        temp_file = f"{latents_file}.{os.getpid()}.tmp"
+        import torch
+        try:
+            torch.save({"fingerprint": fingerprint, "latents": latents}, temp_file)
+            os.replace(temp_file, latents_file)
+        except Exception as e:
+            logger.error(msg=f"Failed to save voice latents: {latents_file}", exc_info=e)
+            try:
+                os.remove(temp_file)
+            except FileNotFoundError:
+                pass
+
+
+latents_cache = LatentsCache()
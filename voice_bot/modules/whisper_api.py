@@ -1,5 +1,10 @@
-from faster_whisper import WhisperModel, download_model
-from voice_bot.modules.bot_utils import logger, MODELS_PATH
+from voice_bot.modules.bot_utils import logger, config, MODELS_PATH, STARTED_AT
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Optional
+from numpy import ndarray
+import asyncio
+import time
 import os
 
 # use base size multilang model for ideal performance/quality
@@ -7,15 +12,45 @@ WHISPER_MODEL_NAME = "base"
 WHISPER_MODEL_PATH = os.path.join(MODELS_PATH, f"faster-whisper-{WHISPER_MODEL_NAME}")
 WHISPER_SAMPLE_RATE = 16000
 
-# pre-initialize hisper model at startup
-if not os.path.isdir(WHISPER_MODEL_PATH):
-    path = download_model(WHISPER_MODEL_NAME, output_dir=WHISPER_MODEL_PATH)
-    print(path)
+model = None
+model_lock = Lock()
+stt_executor: Optional[ThreadPoolExecutor] = None
 
-model = WhisperModel(WHISPER_MODEL_PATH, device="cpu", compute_type="int8")
+
+def get_model():
+    """
+    blocking, model is downloaded and created on first use, when config is loaded, with a worker per executor thread
+    faster_whisper is imported here to keep it off the bot startup
+    """
+    global model
+    with model_lock:
+        if model is None:
+            from faster_whisper import WhisperModel, download_model
+            if not os.path.isdir(WHISPER_MODEL_PATH):
+                download_model(WHISPER_MODEL_NAME, output_dir=WHISPER_MODEL_PATH)
+            model = WhisperModel(WHISPER_MODEL_PATH, device="cpu", compute_type="int8", num_workers=config.stt_workers)
+            logger.info(f"Whisper model is ready in {time.monotonic() - STARTED_AT:.1f}s since start")
+        return model
+
+
+def get_stt_executor() -> ThreadPoolExecutor:
+    global stt_executor
+    if stt_executor is None:
+        stt_executor = ThreadPoolExecutor(max_workers=config.stt_workers, thread_name_prefix="stt_worker")
+    return stt_executor
+
+
+def preload_model() -> None:
+    """load the model in background, transcription requests wait for it on the executor"""
+    get_stt_executor().submit(get_model)
 
 
 def transcribe_voice(voice_file: str) -> str:
-    segments, info = model.transcribe(voice_file)
+    segments, info = get_model().transcribe(voice_file)
     logger.debug(f"Detected language {info.language} with probability {info.language_probability}")
     return ''.join([seg.text for seg in segments])
+
+
+async def transcribe_voice_async(audio: ndarray) -> str:
+    """transcribe on the speech-to-text executor, so that it doesn't wait for or block synthesis"""
+    return await asyncio.get_running_loop().run_in_executor(get_stt_executor(), transcribe_voice, audio)
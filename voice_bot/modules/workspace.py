@@ -0,0 +1,96 @@
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+from threading import Lock
+from typing import Dict, List, Tuple
+from voice_bot.modules.bot_utils import DATA_PATH, config, logger
+
+
+WORKSPACES_PATH = os.path.join(DATA_PATH, "workspaces")
+JANITOR_INTERVAL = 600  # seconds
+
+
+class Workspace(object):
+    """
+    Unique scratch directory of a single request, reference counted,
+    removed when the last holder releases it
+    """
+    def __init__(self, prefix: str) -> None:
+        self.refs = 1
+        self.lock = Lock()
+        with active_lock:  # so that janitor doesn't see the new directory as orphaned
+            self.path = tempfile.mkdtemp(prefix=f"{prefix}_", dir=WORKSPACES_PATH)
+            active_workspaces[self.path] = self
+
+    def acquire(self) -> "Workspace":
+        with self.lock:
+            self.refs += 1
+        return self
+
+    def release(self) -> None:
+        with self.lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+        with active_lock:
+            active_workspaces.pop(self.path, None)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+active_workspaces: Dict[str, Workspace] = {}
+active_lock = Lock()
+os.makedirs(WORKSPACES_PATH, exist_ok=True)
+
+
+def get_dir_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+            except OSError:  # removed in the meantime
+                pass
+    return size
+
+
+def clean_workspaces() -> None:
+    """
+    blocking, remove orphaned workspaces (left by crashed requests or previous runs)
+    older than the ttl, then the oldest ones until the rest fits the disk budget
+    workspaces in use are never removed
+    """
+    now = time.time()
+    with os.scandir(WORKSPACES_PATH) as it:
+        entries = [entry for entry in it if entry.is_dir()]
+    with active_lock:  # taken after listing, so it includes every listed workspace in use
+        active = set(active_workspaces.keys())
+    orphans: List[Tuple[float, str, int]] = []  # (mtime, path, size)
+    for entry in entries:
+        if entry.path in active:
+            continue
+        try:
+            orphans.append((entry.stat().st_mtime, entry.path, get_dir_size(entry.path)))
+        except FileNotFoundError:  # released in the meantime
+            pass
+    orphans.sort()
+    total_size = sum(size for _, _, size in orphans)
+    removed = 0
+    for mtime, path, size in orphans:
+        if now - mtime < config.workspace_ttl and total_size <= config.workspaces_size:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+        removed += 1
+    if removed:
+        logger.info(f"Janitor removed {removed} orphaned workspaces")
+
+
+async def run_janitor() -> None:
+    while True:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, clean_workspaces)
+        except Exception as e:
+            logger.error(msg="Exception while cleaning workspaces:", exc_info=e)
+        await asyncio.sleep(JANITOR_INTERVAL)